@@ -1,5 +1,7 @@
 from aiogram.types import Message
 
+from image_analyz.image_io import is_raw_name, raw_supported
+
 # В данном файле идут проверки на корректность инпута от пользователя
 # Если мы ожидаем сообщение или фото в виде документа для функции, то любой иной ввод не будет обработан
 # Делается в избежании ошибок в боте и чтобы человек понял что нужно
@@ -33,7 +35,13 @@ def validate_document_photo_only(message: Message) -> tuple[bool, str]:
         else:
             return False, "Отправьте фото документом.\nДля этого: Прикрепить → Файл → Выбрать фото"
 
-    if not message.document.mime_type or not message.document.mime_type.startswith("image/"):
+    # RAW (DNG, CR2, NEF...) Telegram часто присылает как application/octet-stream, поэтому смотрим и на расширение
+    is_raw = is_raw_name(message.document.file_name)
+    if is_raw and not raw_supported():
+        return False, "RAW-файлы пока не поддерживаются. Отправьте фото в JPEG, PNG, TIFF или HEIC"
+
+    is_image = message.document.mime_type and message.document.mime_type.startswith("image/")
+    if not is_image and not is_raw:
         return False, "Отправьте фото документом.\nДля этого: Прикрепить → Файл → Выбрать фото"
 
     return True, ""
\ No newline at end of file
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMediaGroup
+
+from monitoring.metrics import OUTBOUND_QUEUE, OUTBOUND_RETRY_AFTER
+
+# Ограничение исходящих запросов к Telegram.
+# Все вызовы Bot API проходят через middleware сессии бота (OutboundLimiter), поэтому
+# очередь одна на весь бот: ответы обработчиков, фоновые диаграммы, сводки профилирования.
+# Запросы с chat_id (отправка и редактирование сообщений) ждут токен в корзине своего чата
+# и в общей корзине бота, и при всплеске нагрузки ответы приходят медленнее, а не падают
+# с ошибкой flood control. Если Telegram всё же ответил RetryAfter, на указанное время
+# приостанавливается чат, и запрос повторяется. По ответу не понять, превышен лимит чата
+# или общий, поэтому весь бот приостанавливается, только если за GLOBAL_FLOOD_WINDOW
+# секунд RetryAfter получили хотя бы GLOBAL_FLOOD_CHATS разных чатов: одна шумная группа
+# с паузой в десятки секунд не задерживает ответы остальным пользователям.
+# Запросы без chat_id (getUpdates, getFile, answerCallbackQuery) не ограничиваются.
+# Лимиты Telegram: около 30 сообщений в секунду на бота, около 1 в секунду в личном
+# чате (короткие всплески допустимы) и 20 в минуту в группе.
+
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))  # Сообщений в секунду на бота
+GLOBAL_BURST = int(os.getenv("TELEGRAM_GLOBAL_BURST", 30))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))  # Сообщений в секунду в личном чате
+CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 4))  # Ответ на фото - до 4 сообщений подряд
+GROUP_RATE = 20 / 60  # Сообщений в секунду в группе
+GROUP_BURST = 5
+MAX_RETRIES = 3  # Сколько раз повторять запрос после RetryAfter
+GLOBAL_FLOOD_CHATS = int(os.getenv("TELEGRAM_GLOBAL_FLOOD_CHATS", 3))  # 0 - никогда не останавливать весь бот
+GLOBAL_FLOOD_WINDOW = 5.0  # За сколько секунд учитываются RetryAfter разных чатов
+MAX_IDLE_BUCKETS = 10_000  # Больше корзин чатов - удаляем полные (давно неактивные)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше burst про запас.
+    Ожидающие получают токены по очереди (asyncio.Lock пропускает в порядке прихода).
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = None
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until
+
+    def pause(self, seconds):
+        """Не выдавать токены seconds секунд (после RetryAfter от Telegram)."""
+        loop = asyncio.get_running_loop()
+        self.paused_until = max(self.paused_until, loop.time() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self, tokens=1):
+        # Альбом больше корзины всё равно нужно отправить: ждём полную корзину
+        tokens = min(tokens, self.burst)
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                self._refill(now)
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Middleware сессии бота: корзины токенов по чатам и общая, повтор после RetryAfter."""
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.recent_floods = deque()  # (время, чат) последних RetryAfter
+
+    def is_global_flood(self, chat_id):
+        """Запоминает RetryAfter чата; True, если за окно их получили GLOBAL_FLOOD_CHATS разных чатов."""
+        now = asyncio.get_running_loop().time()
+        self.recent_floods.append((now, chat_id))
+        while self.recent_floods[0][0] < now - GLOBAL_FLOOD_WINDOW:
+            self.recent_floods.popleft()
+        return GLOBAL_FLOOD_CHATS > 0 and len({chat for _, chat in self.recent_floods}) >= GLOBAL_FLOOD_CHATS
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_IDLE_BUCKETS:
+                now = asyncio.get_running_loop().time()
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items() if not value.is_full(now)
+                }
+            # Id групп и каналов отрицательные, username канала - строка
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            bucket = TokenBucket(GROUP_RATE, GROUP_BURST) if is_group else TokenBucket(CHAT_RATE, CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, getFile, answerCallbackQuery и т.п. не ограничиваем
+            return await make_request(bot, method)
+
+        # Альбом - несколько сообщений
+        messages = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        bucket = self.chat_bucket(chat_id)
+        for attempt in range(MAX_RETRIES + 1):
+            # Сначала свой чат, потом общая корзина: чат, ждущий своей очереди, не занимает общие токены
+            with OUTBOUND_QUEUE.track_inprogress():
+                await bucket.acquire(messages)
+                await self.global_bucket.acquire(messages)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                OUTBOUND_RETRY_AFTER.inc(method=type(method).__name__)
+                if attempt == MAX_RETRIES:
+                    raise
+                logger.warning("Flood control в чате %s: повтор через %s с", chat_id, e.retry_after)
+                bucket.pause(e.retry_after)
+                if self.is_global_flood(chat_id):
+                    logger.warning("Flood control в нескольких чатах: пауза всего бота на %s с", e.retry_after)
+                    self.global_bucket.pause(e.retry_after)
@@ -0,0 +1,215 @@
+# Пересчёт рейтингов после изменения реализации метрик.
+#
+# У каждой метрики есть версия (@version в image_analyz.metrics), а в каждой записи
+# ratings - версии метрик, которыми она посчитана (metric_versions, у старых записей - 1).
+# Пересчёт находит записи с устаревшими метриками, берёт их фото из хранилища
+# изображений (IMAGE_STORE_DIR, см. data/image_store.py) и пересчитывает только
+# устаревшие столбцы:
+# - процесс работает с пониженным приоритетом (os.nice), чтобы не мешать боту;
+# - записи обрабатываются порциями, фото порции анализируются параллельно в потоках,
+#   одно фото из нескольких записей анализируется один раз;
+# - после каждой записанной порции сохраняется контрольная точка (id последней
+#   просмотренной записи), так что прерванный пересчёт продолжается с того же места.
+# Записи без фото в хранилище пересчитать нельзя, они только подсчитываются.
+# Бот держит рейтинги в кэше: после пересчёта его нужно перечитать командой /reload_cache.
+#
+# Запуск из консоли:
+#     IMAGE_STORE_DIR=images python -m data.backfill
+#     IMAGE_STORE_DIR=images python -m data.backfill --metric noise --batch-size 16 --workers 4 --dry-run
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select, update
+
+from data import image_store
+from data.db import async_session
+from data.metric_versions import METRIC_COLUMNS, column_values, current_versions, outdated_metrics, stored_versions
+from data.models import Rating
+from data.schema import upgrade_schema
+from image_analyz.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 32  # Записей в одной порции пересчёта (и в одной транзакции записи)
+SCAN_PAGE = 1000  # Записей в одном запросе при поиске устаревших
+WORKERS = min(4, os.cpu_count() or 1)
+NICE = 10  # На сколько понизить приоритет процесса
+CHECKPOINT_PATH = "backfill_checkpoint.json"
+
+
+def load_checkpoint(path, target):
+    """id последней обработанной записи, если контрольная точка относится к тому же пересчёту."""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    # Если с тех пор изменились версии или список метрик, устаревшие записи могли появиться и раньше
+    return checkpoint["last_id"] if checkpoint.get("target") == target else 0
+
+
+def save_checkpoint(path, target, last_id):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"target": target, "last_id": last_id}, f)
+    os.replace(tmp_path, path)
+
+
+async def scan(after_id, versions, stats, batch_size=BATCH_SIZE):
+    """
+    Следующие устаревшие записи после after_id: ([(id, sha256 фото, устаревшие метрики, версии)], id последней
+    просмотренной записи). Записи без фото в хранилище только подсчитываются в stats.
+    """
+    columns = [getattr(Rating, columns[0]) for columns in METRIC_COLUMNS.values()]
+    found, last_id = [], after_id
+    while len(found) < batch_size:
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(Rating.id, Rating.metric_versions, Rating.image_hash, *columns)
+                .where(Rating.id > last_id)
+                .order_by(Rating.id)
+                .limit(SCAN_PAGE)
+            )).all()
+        if not rows:
+            break
+        for row in rows:
+            last_id = row.id
+            stats["scanned"] += 1
+            outdated = outdated_metrics(row, versions)
+            if not outdated:
+                continue
+            if row.image_hash is None:
+                stats["no_image"] += 1
+            else:
+                found.append((row.id, row.image_hash, outdated, stored_versions(row)))
+                if len(found) == batch_size:
+                    break
+    return found, last_id
+
+
+def recompute(image_hash, metric_names):
+    """Значения столбцов для метрик metric_names по фото из хранилища или None, если фото нет."""
+    image_data = image_store.load(image_hash)
+    if image_data is None:
+        return None
+    metric_functions = get_metrics()
+    values = {}
+    for name in metric_names:
+        # Метрики одного фото делят общие расчёты через per_image_cache
+        values.update(column_values(name, metric_functions[name](image_data)))
+    return values
+
+
+async def write_updates(updates):
+    """Записывает пересчитанные значения одной транзакцией."""
+    # Массовый UPDATE по первичному ключу: строки с одинаковым набором столбцов - одним executemany
+    groups = defaultdict(list)
+    for values in updates:
+        groups[tuple(sorted(values))].append(values)
+    async with async_session() as session:
+        for rows in groups.values():
+            await session.execute(update(Rating), rows)
+        await session.commit()
+
+
+async def backfill(
+    metrics=None, batch_size=BATCH_SIZE, workers=WORKERS, checkpoint_path=CHECKPOINT_PATH, restart=False, dry_run=False
+):
+    """
+    Пересчитывает устаревшие метрики (все или только metrics) в записях с фото в хранилище.
+    Возвращает статистику: просмотрено, пересчитано, без фото, фото не найдено.
+    """
+    await upgrade_schema()  # В старой БД может не быть столбцов metric_versions и image_hash
+    versions = current_versions()
+    if metrics:
+        unknown = set(metrics) - set(versions)
+        if unknown:
+            raise ValueError(f"Неизвестные метрики: {', '.join(sorted(unknown))}")
+        versions = {name: version for name, version in versions.items() if name in metrics}
+    if not image_store.is_enabled() and not dry_run:
+        raise RuntimeError("Хранилище изображений не задано: укажите IMAGE_STORE_DIR")
+
+    target = {"versions": versions}
+    last_id = 0 if restart else load_checkpoint(checkpoint_path, target)
+    if last_id:
+        logger.info("Продолжаем с записи id > %s", last_id)
+
+    stats = Counter()
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+        while True:
+            batch, last_id = await scan(last_id, versions, stats, batch_size)
+            if not dry_run and batch:
+                # Одно фото может стоять в нескольких записях (например, разными методами)
+                by_hash = defaultdict(list)
+                for rating_id, image_hash, outdated, stored in batch:
+                    by_hash[image_hash].append((rating_id, outdated, stored))
+                hashes = list(by_hash)
+                results = await asyncio.gather(*(
+                    loop.run_in_executor(
+                        pool, recompute, image_hash,
+                        sorted({name for _, outdated, _ in by_hash[image_hash] for name in outdated}),
+                    )
+                    for image_hash in hashes
+                ))
+
+                updates = []
+                for image_hash, values in zip(hashes, results):
+                    for rating_id, outdated, stored in by_hash[image_hash]:
+                        if values is None:
+                            stats["missing_image"] += 1
+                            continue
+                        row = {"id": rating_id}
+                        for name in outdated:
+                            row.update({column: values[column] for column in METRIC_COLUMNS[name]})
+                        row["metric_versions"] = json.dumps({**stored, **{name: versions[name] for name in outdated}})
+                        updates.append(row)
+                if updates:
+                    await write_updates(updates)
+                stats["recomputed"] += len(updates)
+            elif dry_run:
+                stats["recomputed"] += len(batch)
+
+            if not dry_run:
+                save_checkpoint(checkpoint_path, target, last_id)
+            logger.info("Просмотрено %s, пересчитано %s", stats["scanned"], stats["recomputed"])
+            if not batch:
+                break
+    return stats
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Пересчёт рейтингов, посчитанных устаревшими версиями метрик")
+    parser.add_argument("--metric", action="append", help="Пересчитать только эту метрику (можно несколько раз)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Записей в одной порции")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Сколько фото анализировать одновременно")
+    parser.add_argument("--nice", type=int, default=NICE, help="На сколько понизить приоритет процесса")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="Файл контрольной точки")
+    parser.add_argument("--restart", action="store_true", help="Начать сначала, не учитывая контрольную точку")
+    parser.add_argument("--dry-run", action="store_true", help="Только подсчитать устаревшие записи")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.nice and hasattr(os, "nice"):
+        os.nice(args.nice)  # До создания потоков: в Linux приоритет наследуется новыми потоками
+
+    stats = asyncio.run(backfill(
+        args.metric, args.batch_size, args.workers, args.checkpoint, args.restart, args.dry_run
+    ))
+    print(
+        f"Просмотрено записей: {stats['scanned']}, "
+        f"{'требуют пересчёта' if args.dry_run else 'пересчитано'}: {stats['recomputed']}, "
+        f"без фото в хранилище: {stats['no_image']}, фото не найдено: {stats['missing_image']}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,10 +1,12 @@
 import asyncio
 from data.db import engine
 from data.models import Base
+from data.schema import upgrade_schema
 
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await upgrade_schema()
 
 if __name__ == "__main__":
     asyncio.run(create_db())
\ No newline at end of file
@@ -1,7 +1,10 @@
+import os
+
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-DATABASE_URL = "sqlite+aiosqlite:///ratings.db"
+# БД можно переопределить переменной окружения (например, временная БД для нагрузочного теста)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///ratings.db")
 
 engine = create_async_engine(DATABASE_URL, echo=False)
 async_session = async_sessionmaker(engine, expire_on_commit=False)
@@ -0,0 +1,142 @@
+# Потоковая выгрузка таблицы ratings (вместе с названием модели) в Parquet или CSV
+# для офлайн-анализа в pandas.
+#
+# Строки читаются из БД порциями (stream + yield_per) и сразу дописываются в файл,
+# поэтому память не растёт с размером таблицы.
+# Для Parquet нужен pyarrow (pip install pyarrow); CSV пишется через pandas.
+#
+# Запуск из консоли:
+#     python -m data.export ratings.parquet
+#     python -m data.export ratings.csv --model "iPhone 14" --model "iPhone 15" --method method4 --since 2025-05-01
+
+import argparse
+import asyncio
+import sys
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import DateTime, Float, Integer, select
+
+from data.db import async_session
+from data.models import PhoneModel, Rating
+from data.schema import upgrade_schema
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow не установлен - доступна только выгрузка в CSV
+    pa = None
+    pq = None
+
+CHUNK_SIZE = 10_000  # Строк в одной порции чтения и записи
+
+
+def build_query(models=None, methods=None, since=None, until=None):
+    """SELECT всех столбцов ratings и названия модели с необязательными фильтрами."""
+    query = (
+        select(PhoneModel.name.label("phone_model"), *Rating.__table__.columns)
+        .join(PhoneModel, PhoneModel.id == Rating.phone_model_id)
+        .order_by(Rating.id)
+    )
+    if models:
+        query = query.where(PhoneModel.name.in_(models))
+    if methods:
+        query = query.where(Rating.analysis_method.in_(methods))
+    if since:
+        query = query.where(Rating.created_at >= since)
+    if until:
+        query = query.where(Rating.created_at < until)
+    return query
+
+
+def _arrow_schema():
+    """Схема Parquet по типам столбцов, чтобы порции с пустыми значениями не меняли типы."""
+    fields = [pa.field("phone_model", pa.string())]
+    for column in Rating.__table__.columns:
+        if isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, Float):
+            arrow_type = pa.float64()
+        elif isinstance(column.type, DateTime):
+            arrow_type = pa.timestamp("us")
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+class _ParquetWriter:
+    def __init__(self, path):
+        if pq is None:
+            raise RuntimeError("Для выгрузки в Parquet установите pyarrow (pip install pyarrow)")
+        self.schema = _arrow_schema()
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema,
+        ))
+
+    def close(self):
+        self.writer.close()
+
+
+class _CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.columns = ["phone_model"] + [column.name for column in Rating.__table__.columns]
+        self.header = True
+
+    def write(self, rows):
+        pd.DataFrame.from_records(rows, columns=self.columns).to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.file.close()
+
+
+async def export_ratings(path, file_format=None, models=None, methods=None, since=None, until=None,
+                         chunk_size=CHUNK_SIZE):
+    """
+    Выгружает рейтинги в path (формат - parquet или csv, по умолчанию по расширению).
+    Возвращает число выгруженных строк.
+    """
+    await upgrade_schema()  # В старой БД может не быть столбца created_at
+    file_format = file_format or ("parquet" if str(path).endswith(".parquet") else "csv")
+    writer = _ParquetWriter(path) if file_format == "parquet" else _CsvWriter(path)
+    exported = 0
+    try:
+        async with async_session() as session:
+            result = await session.stream(
+                build_query(models, methods, since, until).execution_options(yield_per=chunk_size)
+            )
+            async for rows in result.partitions():
+                writer.write(rows)
+                exported += len(rows)
+    finally:
+        writer.close()
+    return exported
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Выгрузка рейтингов в Parquet или CSV")
+    parser.add_argument("output", help="Файл выгрузки (.parquet или .csv)")
+    parser.add_argument("--format", choices=("parquet", "csv"), help="Формат (по умолчанию по расширению)")
+    parser.add_argument("--model", action="append", help="Модель телефона (можно указать несколько раз)")
+    parser.add_argument("--method", action="append", help="Метод анализа, например method4 (можно несколько раз)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Не раньше этого времени (UTC, ISO 8601)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Раньше этого времени (UTC, ISO 8601)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Строк в одной порции")
+    args = parser.parse_args(argv)
+
+    exported = asyncio.run(export_ratings(
+        args.output, args.format, args.model, args.method, args.since, args.until, args.chunk_size,
+    ))
+    print(f"Выгружено строк: {exported} -> {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
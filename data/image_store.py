@@ -0,0 +1,53 @@
+import hashlib
+import os
+import tempfile
+
+from image_analyz.image_io import decode_file
+
+# Хранилище изображений с адресацией по содержимому: файл лежит в
+# IMAGE_STORE_DIR/<первые 2 символа sha256>/<sha256>, одинаковые фото хранятся один раз.
+# Включается переменной окружения IMAGE_STORE_DIR; без неё изображения не сохраняются,
+# и рейтинги нельзя пересчитать после изменения метрик (см. data.backfill).
+# Хранится сам загруженный файл: анализ декодирует именно его, поэтому пересчёт
+# видит те же пиксели, что и исходный анализ, а места файл занимает меньше любой
+# распакованной копии.
+
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR")
+HASH_CHUNK = 1024 * 1024
+
+
+def is_enabled():
+    return bool(IMAGE_STORE_DIR)
+
+
+def path_for(image_hash):
+    return os.path.join(IMAGE_STORE_DIR, image_hash[:2], image_hash)
+
+
+def put_file(file_path):
+    """Копирует файл в хранилище (если его там ещё нет) и возвращает его sha256."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    image_hash = digest.hexdigest()
+
+    target = path_for(image_hash)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Пишем во временный файл рядом и переименовываем: в хранилище не бывает недописанных файлов
+        with open(file_path, "rb") as src, tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(target), delete=False
+        ) as tmp:
+            for chunk in iter(lambda: src.read(HASH_CHUNK), b""):
+                tmp.write(chunk)
+        os.replace(tmp.name, target)
+    return image_hash
+
+
+def load(image_hash):
+    """Декодированное изображение из хранилища или None, если файла нет."""
+    path = path_for(image_hash)
+    if not os.path.exists(path):
+        return None
+    return decode_file(path)
@@ -0,0 +1,64 @@
+import json
+
+from image_analyz.metrics import get_metrics
+
+# Версии метрик в рейтингах: в столбце metric_versions каждой записи хранится JSON
+# {метрика: версия} для метрик, значения которых в ней есть. По нему data.backfill
+# находит значения, посчитанные устаревшей реализацией метрики.
+
+# Столбцы ratings, которые заполняет каждая метрика реестра (первый - основное значение)
+METRIC_COLUMNS = {
+    "chromatic_aberration": ("chromatic_aberration",),
+    "vignetting": ("vignetting", "hist", "bin_edges"),
+    "noise": ("noise",),
+    "sharpness": ("sharpness",),
+    "color_gamut": ("color_gamut",),
+    "white_balance": ("white_balance",),
+    "contrast_ratio": ("contrast_ratio",),
+    "glare": ("glare",),
+}
+LEGACY_VERSION = 1  # Версия метрик в записях без metric_versions
+
+
+def current_versions():
+    """{метрика: текущая версия реализации} для метрик, которые хранятся в ratings."""
+    metrics = get_metrics()
+    return {name: getattr(metrics[name], "version", 1) for name in METRIC_COLUMNS if name in metrics}
+
+
+def metrics_in(values):
+    """Метрики, основное значение которых есть в values (словарь или строка ratings)."""
+    get = values.get if isinstance(values, dict) else lambda column: getattr(values, column, None)
+    return [name for name, columns in METRIC_COLUMNS.items() if get(columns[0]) is not None]
+
+
+def versions_json(metrics):
+    """JSON версий для новой записи рейтинга с метриками metrics."""
+    versions = current_versions()
+    return json.dumps({name: versions[name] for name in metrics_in(metrics) if name in versions})
+
+
+def stored_versions(row):
+    """{метрика: версия} для строки ratings; у старых записей - LEGACY_VERSION для всех её метрик."""
+    stored = json.loads(row.metric_versions) if row.metric_versions else {}
+    return {name: stored.get(name, LEGACY_VERSION) for name in metrics_in(row)}
+
+
+def outdated_metrics(row, versions=None):
+    """Метрики строки ratings, посчитанные более старой версией, чем текущая."""
+    versions = versions or current_versions()
+    return [name for name, stored in stored_versions(row).items() if stored < versions.get(name, stored)]
+
+
+def column_values(name, result):
+    """
+    Значения столбцов ratings из результата метрики реестра (как их записывает бот):
+    словари разбираются по столбцам, списки (hist, bin_edges) сохраняются в JSON.
+    """
+    if not isinstance(result, dict):
+        return {name: result}
+    values = {}
+    for column in METRIC_COLUMNS[name]:
+        value = result.get(column)
+        values[column] = json.dumps(value) if isinstance(value, list) else value
+    return values
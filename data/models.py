@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Text, create_engine
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Text, DateTime, Index, create_engine, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from data.db import Base
@@ -32,7 +32,16 @@ class Rating(Base):
     color_gamut = Column(Float)
     white_balance = Column(Float)
     contrast_ratio = Column(Float)
+    glare = Column(Float)  # Блики (10 - бликов нет)
     total_score = Column(Float)
+    created_at = Column(DateTime, default=func.now())  # Время анализа (UTC); у записей до появления столбца пусто
+    metric_versions = Column(String)  # JSON {метрика: версия реализации}; пусто у записей до появления версий (версия 1)
+    image_hash = Column(String)  # sha256 исходного файла в хранилище изображений (если оно включено)
 
     # Связь с моделью телефона
     phone_model = relationship("PhoneModel")
+
+    # Все выборки рейтингов (таблица, сравнение моделей) идут по методу и модели
+    __table_args__ = (
+        Index("ix_ratings_method_model", "analysis_method", "phone_model_id"),
+    )
@@ -0,0 +1,209 @@
+from collections import namedtuple
+from collections.abc import Mapping
+from dataclasses import make_dataclass
+
+import numpy as np
+from sqlalchemy import Float, Text
+
+from data.models import Rating
+
+# Колоночный кэш таблицы ratings в памяти процесса.
+# Рейтинги разложены по блокам (метод, модель); в блоке каждая числовая метрика -
+# массив numpy float64 (NaN - значения нет), текстовые столбцы (hist, bin_edges) - списки.
+# Кэш загружается один раз при старте и дополняется при каждом добавлении рейтинга,
+# поэтому он верен, только пока бот - единственный, кто пишет в БД. После записи в обход
+# бота (пересчёт python -m data.backfill) кэш перечитывается командой /reload_cache.
+
+NUMERIC_COLUMNS = [c.name for c in Rating.__table__.columns if isinstance(c.type, Float)]
+TEXT_COLUMNS = [c.name for c in Rating.__table__.columns if isinstance(c.type, Text)]
+INITIAL_CAPACITY = 64
+
+ComparisonRow = namedtuple("ComparisonRow", "rank phone_model mean median photos")
+
+# Строка рейтинга для чтения (из кэша и из БД): те же атрибуты, что у Rating, плюс название
+# модели phone_model. Поля собираются по столбцам модели, чтобы не расходиться с ней.
+RATING_ROW_FIELDS = ["phone_model_id", "phone_model", "photo_name", "analysis_method", *NUMERIC_COLUMNS, *TEXT_COLUMNS]
+RatingRow = make_dataclass("RatingRow", RATING_ROW_FIELDS, slots=True)
+
+
+class RatingColumns:
+    """
+    Рейтинги по столбцам - для агрегатов и диаграмм: columns.metric("noise") - массив numpy
+    float64 (NaN - значения нет), photo_name, phone_model и text (hist, bin_edges) - списки.
+    Из кэша массивы берутся срезами блоков, без объекта на каждую строку. Итерация даёт
+    RatingRow - только там, где строка нужна целиком (гистограммы виньетирования по фото).
+    """
+
+    def __init__(self, photo_name, phone_model, numeric, text):
+        self.photo_name = photo_name
+        self.phone_model = phone_model
+        self.numeric = numeric
+        self.text = text
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Столбцы из строк: словарей, RowMapping или объектов с атрибутами (RatingRow)."""
+        rows = [
+            row if isinstance(row, Mapping) else {name: getattr(row, name, None) for name in RATING_ROW_FIELDS}
+            for row in rows
+        ]
+        return cls(
+            [row.get("photo_name") for row in rows],
+            [row.get("phone_model") for row in rows],
+            # None при приведении к float становится NaN
+            {name: np.array([row.get(name) for row in rows], dtype=np.float64) for name in NUMERIC_COLUMNS},
+            {name: [row.get(name) for row in rows] for name in TEXT_COLUMNS},
+        )
+
+    def __len__(self):
+        return len(self.photo_name)
+
+    def metric(self, name):
+        """Числовой столбец; для метрики, которой нет в таблице, - массив NaN."""
+        column = self.numeric.get(name)
+        return column if column is not None else np.full(len(self), np.nan)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            values = {name: column[i] for name, column in self.numeric.items()}
+            yield RatingRow(
+                phone_model_id=None,
+                phone_model=self.phone_model[i],
+                photo_name=self.photo_name[i],
+                analysis_method=None,
+                # NaN != NaN: так пропуски превращаются обратно в None
+                **{name: None if value != value else float(value) for name, value in values.items()},
+                **{name: column[i] for name, column in self.text.items()},
+            )
+
+
+class _Block:
+    """Рейтинги одной модели по одному методу."""
+
+    def __init__(self):
+        self.size = 0
+        self.photo_names = []
+        self.numeric = {name: np.full(INITIAL_CAPACITY, np.nan) for name in NUMERIC_COLUMNS}
+        self.text = {name: [] for name in TEXT_COLUMNS}
+
+    def _reserve(self, count):
+        """Увеличивает массивы (вдвое или до нужного размера), если в них не помещается count строк."""
+        capacity = self.numeric[NUMERIC_COLUMNS[0]].shape[0]
+        if self.size + count <= capacity:
+            return
+        new_capacity = max(capacity * 2, self.size + count)
+        for name, array in self.numeric.items():
+            grown = np.full(new_capacity, np.nan)
+            grown[:self.size] = array[:self.size]
+            self.numeric[name] = grown
+
+    def extend(self, rows):
+        """Добавляет строки (словари или RowMapping со столбцами Rating и photo_name)."""
+        count = len(rows)
+        self._reserve(count)
+        for name in NUMERIC_COLUMNS:
+            # None при приведении к float становится NaN
+            self.numeric[name][self.size:self.size + count] = np.array(
+                [row.get(name) for row in rows], dtype=np.float64
+            )
+        for name in TEXT_COLUMNS:
+            self.text[name].extend(row.get(name) for row in rows)
+        self.photo_names.extend(row["photo_name"] for row in rows)
+        self.size += count
+
+    def column(self, name):
+        return self.numeric[name][:self.size]
+
+    def read_only_column(self, name):
+        """Срез столбца без копии; запись через него запрещена, чтобы не испортить кэш."""
+        view = self.column(name)
+        view.flags.writeable = False
+        return view
+
+
+class RatingsCache:
+    def __init__(self):
+        self.loaded = False
+        self.blocks = {}  # (метод, id модели) -> _Block
+        self.phone_models = {}  # название -> PhoneModel
+
+    def add_phone_model(self, phone_model):
+        self.phone_models[phone_model.name] = phone_model
+
+    def add(self, phone_model_id, analysis_method, rows):
+        """Добавляет рейтинги модели по методу; rows - словари с photo_name и метриками."""
+        block = self.blocks.get((analysis_method, phone_model_id))
+        if block is None:
+            block = self.blocks[(analysis_method, phone_model_id)] = _Block()
+        block.extend(rows)
+
+    def _model_names(self):
+        return {model.id: model.name for model in self.phone_models.values()}
+
+    def ratings(self, phone_model_id, analysis_method, phone_model_name=None):
+        """Рейтинги модели по методу - RatingRow (те же атрибуты, что у Rating)."""
+        block = self.blocks.get((analysis_method, phone_model_id))
+        if block is None:
+            return []
+        # NaN != NaN: так пропуски превращаются обратно в None
+        columns = {
+            name: [None if value != value else value for value in block.column(name).tolist()]
+            for name in NUMERIC_COLUMNS
+        }
+        columns.update(block.text)
+        # Значения идут в порядке полей RatingRow: числовые столбцы, затем текстовые
+        return [
+            RatingRow(phone_model_id, phone_model_name, photo_name, analysis_method, *values)
+            for photo_name, *values in zip(block.photo_names, *columns.values())
+        ]
+
+    def columns(self, analysis_method, phone_model_id=None):
+        """
+        RatingColumns по методу: всех моделей или только phone_model_id.
+        Для одного блока числовые столбцы - срезы кэша без копии, для нескольких - np.concatenate.
+        """
+        names = self._model_names()
+        blocks = [
+            (block_model_id, block) for (method, block_model_id), block in self.blocks.items()
+            if method == analysis_method and phone_model_id in (None, block_model_id)
+        ]
+        if len(blocks) == 1:
+            numeric = {name: blocks[0][1].read_only_column(name) for name in NUMERIC_COLUMNS}
+        else:
+            numeric = {
+                name: np.concatenate([block.column(name) for _, block in blocks]) if blocks else np.empty(0)
+                for name in NUMERIC_COLUMNS
+            }
+        # Списки копируются срезами целиком, без цикла по строкам
+        photo_names, phone_models = [], []
+        text = {name: [] for name in TEXT_COLUMNS}
+        for block_model_id, block in blocks:
+            photo_names.extend(block.photo_names)
+            phone_models.extend([names.get(block_model_id)] * block.size)
+            for name in TEXT_COLUMNS:
+                text[name].extend(block.text[name])
+        return RatingColumns(photo_names, phone_models, numeric, text)
+
+    def compare(self, analysis_method, column, higher_is_better, model_names=None):
+        """
+        Среднее и медиана метрики по моделям и место в рейтинге (как RANK() в SQL:
+        одинаковые средние - одно место, следующее место пропускается).
+        """
+        names = self._model_names()
+        stats = []
+        for (method, phone_model_id), block in self.blocks.items():
+            name = names.get(phone_model_id)
+            if method != analysis_method or (model_names and name not in model_names):
+                continue
+            values = block.column(column)
+            values = values[~np.isnan(values)]
+            if values.size:
+                stats.append((name, float(values.mean()), float(np.median(values)), int(values.size)))
+
+        if not stats:
+            return []
+        means = np.array([mean for _, mean, _, _ in stats])
+        keys = -means if higher_is_better else means
+        order = np.lexsort((np.array([name for name, *_ in stats]), keys))
+        ranks = np.searchsorted(np.sort(keys), keys, side="left") + 1
+        return [ComparisonRow(int(ranks[i]), *stats[i]) for i in order]
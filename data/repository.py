@@ -1,9 +1,104 @@
-from sqlalchemy import select
+from collections import defaultdict
+from functools import wraps
+from sqlalchemy import bindparam, case, func, insert, select
 from data.models import PhoneModel, Rating
-from data.db import async_session
+from data.db import async_session, engine
+from data.metric_versions import versions_json
+from data.ratings_cache import NUMERIC_COLUMNS, TEXT_COLUMNS, RatingColumns, RatingRow, RatingsCache
+from monitoring.metrics import DB_QUERY_SECONDS
+
+
+# Основная метрика каждого метода для сравнения моделей: (столбец, чем больше, тем лучше)
+PRIMARY_METRICS = {
+    "method1": ("chromatic_aberration", True),
+    "method2": ("vignetting", True),
+    "method3": ("noise", False),  # 10 - сильный шум
+    "method4": ("sharpness", True),
+    "method5": ("color_gamut", True),
+}
+
+# Счётчик изменений рейтингов по методу: по нему бот понимает, что кэш сравнения устарел
+_ratings_versions = defaultdict(int)
+
+# Колоночный кэш рейтингов (см. data/ratings_cache.py). Пока он не загружен
+# методом load_cache, все чтения идут в БД.
+_cache = RatingsCache()
+CACHE_LOAD_CHUNK = 10_000
+
+# Запись и чтение рейтингов через SQLAlchemy Core: таблица плоская, ORM-объекты, identity map
+# и flush сессии здесь ничего не дают. Запросы собраны один раз при импорте, поэтому
+# скомпилированный SQL каждый раз берётся из кэша компиляции SQLAlchemy.
+_EMPTY_METRICS = dict.fromkeys(NUMERIC_COLUMNS + TEXT_COLUMNS)
+_insert_rating = insert(Rating.__table__)
+_select_ratings = select(
+    Rating.phone_model_id,
+    Rating.photo_name,
+    Rating.analysis_method,
+    *[getattr(Rating, name) for name in NUMERIC_COLUMNS + TEXT_COLUMNS],
+).where(
+    Rating.phone_model_id == bindparam("phone_model_id"),
+    Rating.analysis_method == bindparam("analysis_method"),
+).order_by(Rating.id)
+
+
+def _rating_row(phone_model_id, photo_name, analysis_method, metrics, image_hash):
+    """Параметры INSERT одного рейтинга; у всех строк один набор столбцов (нет метрики - NULL)."""
+    return {
+        **_EMPTY_METRICS,
+        "phone_model_id": phone_model_id,
+        "photo_name": photo_name,
+        "analysis_method": analysis_method,
+        "metric_versions": versions_json(metrics),
+        "image_hash": image_hash,
+        **metrics,
+    }
+
+
+def timed_query(query):
+    """Записывает длительность метода репозитория в метрику camera_bot_db_query_seconds."""
+
+    @wraps(query)
+    async def wrapper(*args, **kwargs):
+        with DB_QUERY_SECONDS.time(query=query.__name__):
+            return await query(*args, **kwargs)
+
+    return wrapper
 
 
 class RatingRepository:
+    @timed_query
+    async def load_cache(self):
+        """
+        Загружает модели и все рейтинги в колоночный кэш; дальше чтения идут из памяти.
+        Повторный вызов перечитывает БД (например, после пересчёта рейтингов data.backfill).
+        """
+        global _cache
+        cache = RatingsCache()
+        async with async_session() as session:
+            for phone_model in (await session.execute(select(PhoneModel))).scalars():
+                cache.add_phone_model(phone_model)
+
+            columns = [getattr(Rating, name) for name in NUMERIC_COLUMNS + TEXT_COLUMNS]
+            result = await session.stream(
+                select(Rating.phone_model_id, Rating.analysis_method, Rating.photo_name, *columns)
+                .order_by(Rating.id)
+                .execution_options(yield_per=CACHE_LOAD_CHUNK)
+            )
+            async for rows in result.partitions():
+                # Строки порции раскладываются по блокам (метод, модель) и добавляются пачкой
+                blocks = defaultdict(list)
+                for row in rows:
+                    blocks[(row.phone_model_id, row.analysis_method)].append(row._mapping)
+                for (phone_model_id, analysis_method), block_rows in blocks.items():
+                    cache.add(phone_model_id, analysis_method, block_rows)
+
+        cache.loaded = True
+        _cache = cache
+        # Рейтинги могли измениться в обход бота: кэш диаграмм сравнения больше не действителен
+        for analysis_method in PRIMARY_METRICS:
+            _ratings_versions[analysis_method] += 1
+
+    @timed_query
     async def initialize_default_models(self):
         """Инициализация предустановленных моделей телефонов."""
         async with async_session() as session:
@@ -18,6 +113,7 @@ class RatingRepository:
                     session.add(new_model)
             await session.commit()
 
+    @timed_query
     async def add_phone_model(self, model_name: str) -> PhoneModel:
         """Добавление новой модели телефона."""
         async with async_session() as session:
@@ -33,51 +129,158 @@ class RatingRepository:
             session.add(new_model)
             await session.commit()
             await session.refresh(new_model)
+            if _cache.loaded:
+                _cache.add_phone_model(new_model)
             return new_model
 
+    @timed_query
     async def get_all_phone_models(self):
         """Получение списка всех моделей телефонов."""
+        if _cache.loaded:
+            return list(_cache.phone_models.values())
         async with async_session() as session:
             result = await session.execute(select(PhoneModel))
             return result.scalars().all()
 
+    @timed_query
     async def get_phone_model(self, model_name: str) -> PhoneModel:
         """Получение модели телефона по имени."""
+        if _cache.loaded:
+            return _cache.phone_models.get(model_name)
         async with async_session() as session:
             result = await session.execute(
                 select(PhoneModel).where(PhoneModel.name == model_name)
             )
             return result.scalar_one_or_none()
 
+    @timed_query
     async def add_rating(
-        self, phone_model_id: int, photo_name: str, metrics: dict, analysis_method: str
+        self, phone_model_id: int, photo_name: str, metrics: dict, analysis_method: str, image_hash=None
     ):
-        """Добавление нового рейтинга."""
+        """Добавление нового рейтинга (image_hash - фото в хранилище изображений, если оно включено)."""
+        async with engine.begin() as conn:
+            await conn.execute(
+                _insert_rating, _rating_row(phone_model_id, photo_name, analysis_method, metrics, image_hash)
+            )
+        if _cache.loaded:
+            _cache.add(phone_model_id, analysis_method, [{"photo_name": photo_name, **metrics}])
+        _ratings_versions[analysis_method] += 1
+
+    @timed_query
+    async def add_ratings(self, phone_model_id: int, ratings, analysis_method: str, image_hashes=None):
+        """
+        Добавление нескольких рейтингов одним запросом; ratings - [(имя фото, метрики)],
+        image_hashes - фото в хранилище изображений в том же порядке (если оно включено).
+        """
+        if not ratings:
+            return
+        image_hashes = image_hashes or [None] * len(ratings)
+        async with engine.begin() as conn:
+            await conn.execute(
+                _insert_rating,
+                [
+                    _rating_row(phone_model_id, photo_name, analysis_method, metrics, image_hash)
+                    for (photo_name, metrics), image_hash in zip(ratings, image_hashes)
+                ],
+            )
+        if _cache.loaded:
+            _cache.add(
+                phone_model_id,
+                analysis_method,
+                [{"photo_name": photo_name, **metrics} for photo_name, metrics in ratings],
+            )
+        _ratings_versions[analysis_method] += 1
+
+    def get_ratings_version(self, analysis_method: str) -> int:
+        """Номер версии рейтингов метода; меняется при каждом добавлении."""
+        return _ratings_versions[analysis_method]
+
+    @timed_query
+    async def compare_models(self, analysis_method: str, model_names=None):
+        """
+        Рейтинг моделей по основной метрике метода (PRIMARY_METRICS).
+        Из кэша - numpy по колонкам, без кэша - одним запросом: среднее и медиана
+        считаются в SQL оконными функциями. model_names ограничивает сравнение выбранными моделями.
+        Возвращает строки (rank, phone_model, mean, median, photos), лучшие первыми.
+        """
+        column, higher_is_better = PRIMARY_METRICS[analysis_method]
+        if _cache.loaded:
+            return _cache.compare(analysis_method, column, higher_is_better, model_names)
+        metric = getattr(Rating, column)
+
+        # Номер значения внутри модели и число значений - для медианы
+        ordered = select(
+            Rating.phone_model_id,
+            metric.label("value"),
+            func.row_number().over(partition_by=Rating.phone_model_id, order_by=metric).label("position"),
+            func.count().over(partition_by=Rating.phone_model_id).label("total"),
+        ).where(Rating.analysis_method == analysis_method, metric.is_not(None))
+        if model_names:
+            ordered = ordered.where(
+                Rating.phone_model_id.in_(select(PhoneModel.id).where(PhoneModel.name.in_(model_names)))
+            )
+        ordered = ordered.subquery()
+
+        # Медиана - среднее одного или двух центральных значений
+        is_middle = ordered.c.position.between((ordered.c.total + 1) // 2, (ordered.c.total + 2) // 2)
+        stats = (
+            select(
+                ordered.c.phone_model_id,
+                func.avg(ordered.c.value).label("mean"),
+                func.avg(case((is_middle, ordered.c.value))).label("median"),
+                func.count().label("photos"),
+            )
+            .group_by(ordered.c.phone_model_id)
+            .subquery()
+        )
+
+        order = stats.c.mean.desc() if higher_is_better else stats.c.mean.asc()
         async with async_session() as session:
-            rating = Rating(
-                phone_model_id=phone_model_id,
-                photo_name=photo_name,
-                analysis_method=analysis_method,
-                **metrics,
+            result = await session.execute(
+                select(
+                    func.rank().over(order_by=order).label("rank"),
+                    PhoneModel.name.label("phone_model"),
+                    stats.c.mean,
+                    stats.c.median,
+                    stats.c.photos,
+                )
+                .join(stats, PhoneModel.id == stats.c.phone_model_id)
+                .order_by(order, PhoneModel.name)
             )
-            session.add(rating)
-            await session.commit()
+            return result.all()
 
+    @timed_query
     async def get_ratings_by_model_and_method(
         self, phone_model_id: int, analysis_method: str
     ):
-        """Получение рейтингов для конкретной модели и метода анализа."""
-        async with async_session() as session:
-            result = await session.execute(
-                select(Rating).where(
-                    Rating.phone_model_id == phone_model_id,
-                    Rating.analysis_method == analysis_method,
-                )
+        """Получение рейтингов для конкретной модели и метода анализа (строки RatingRow)."""
+        if _cache.loaded:
+            return _cache.ratings(phone_model_id, analysis_method)
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                _select_ratings, {"phone_model_id": phone_model_id, "analysis_method": analysis_method}
             )
-            return result.scalars().all()
+            return [RatingRow(row[0], None, *row[1:]) for row in result]
 
+    @timed_query
+    async def get_rating_columns(self, phone_model_id: int, analysis_method: str):
+        """Рейтинги модели по методу столбцами (RatingColumns) - для диаграмм."""
+        if _cache.loaded:
+            return _cache.columns(analysis_method, phone_model_id)
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                _select_ratings, {"phone_model_id": phone_model_id, "analysis_method": analysis_method}
+            )
+            return RatingColumns.from_rows(result.mappings().all())
+
+    @timed_query
     async def get_average_ratings(self, analysis_method: str):
-        """Получение средних рейтингов по всем моделям для конкретного метода анализа."""
+        """
+        Получение рейтингов по всем моделям для конкретного метода анализа - столбцами
+        (RatingColumns с названием модели в phone_model) для агрегатов и диаграмм.
+        """
+        if _cache.loaded:
+            return _cache.columns(analysis_method)
         async with async_session() as session:
             result = await session.execute(
                 select(
@@ -92,8 +295,9 @@ class RatingRepository:
                     Rating.color_gamut,
                     Rating.white_balance,
                     Rating.contrast_ratio,
+                    Rating.glare,
                     Rating.total_score,
                 ).join(Rating, PhoneModel.id == Rating.phone_model_id)
                 .where(Rating.analysis_method == analysis_method)
             )
-            return result.all()
+            return RatingColumns.from_rows(result.mappings().all())
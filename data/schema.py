@@ -0,0 +1,33 @@
+from sqlalchemy import inspect, text
+
+from data.db import engine
+from data.models import Base
+
+# create_all создаёт только отсутствующие таблицы; столбцы и индексы, добавленные
+# в модели позже, в уже существующую БД нужно докатывать отдельно.
+# Новые столбцы добавляются без значений по умолчанию на стороне БД (SQLite не умеет
+# ADD COLUMN с CURRENT_TIMESTAMP), поэтому у старых записей они пустые.
+
+
+def _upgrade(conn):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(conn)
+
+
+async def upgrade_schema():
+    """Докатывает на существующую БД столбцы и индексы из моделей."""
+    async with engine.begin() as conn:
+        await conn.run_sync(_upgrade)
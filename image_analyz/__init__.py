@@ -0,0 +1,6 @@
+import os
+
+# Бот работает без дисплея и рисует графики только в память, поэтому matplotlib
+# всегда использует неинтерактивный бэкенд Agg. Для локальной отладки с окнами
+# (show_plot=True) можно задать MPLBACKEND=TkAgg в окружении.
+os.environ.setdefault("MPLBACKEND", "Agg")
@@ -1,19 +1,41 @@
+from contextlib import nullcontext
+
 from .metrics import get_metrics  # Импортируем зарегистрированные метрики
+from . import memory_profiler
+from .scheduler import run_metrics
 
 
 class Image:
     def __init__(self, image_data):
         self.image_data = image_data
         self.metrics = {}  # Словарь для результатов
+        self.memory_report = None  # Отчёт по памяти (если включён MEMORY_PROFILING)
 
-    def analyze(self):
+    def analyze(self, parallel=True):
+        """
+        Считает все метрики; независимые метрики - параллельно (см. image_analyz.scheduler).
+        parallel=False - по очереди в текущем потоке (например, для профилирования запроса).
+        """
         # Получаем все доступные метрики
         metric_functions = get_metrics()
+        # Замеры памяти по каждой метрике, если они включены.
+        # tracemalloc общий для процесса, поэтому метрики в этом случае считаются по очереди,
+        # а замеряемые анализы разных пользователей ждут друг друга (memory_profiler.tracing)
+        tracker = None
+        if memory_profiler.is_enabled():
+            tracker = memory_profiler.MetricMemoryTracker(getattr(self.image_data, "shape", None))
+            parallel = False
         # Применяем каждую метрику
-        for name, func in metric_functions.items():
-            result = func(self.image_data)
+        with memory_profiler.tracing() if tracker else nullcontext():
+            results = run_metrics(
+                self.image_data, metric_functions, parallel=parallel, track=tracker.track if tracker else None
+            )
+        for name, result in results.items():
             if name == "vignetting" and isinstance(result, dict): # Просьба в данном блоке не менять ничего, или сообщить Хромых ИА об изменениях
                 for subname, subvalue in result.items():
                     self.metrics[subname] = subvalue
             else:
                 self.metrics[name] = result
+
+        if tracker:
+            self.memory_report = tracker.finish()
@@ -0,0 +1,173 @@
+# Пакетный бэкенд анализа на Kornia/torch.
+#
+# Несколько декодированных изображений складываются в один CPU-тензор, и общие
+# операции (оттенки серого, Собель, размытие по Гауссу, гистограммы) считаются
+# сразу для всего пакета с внутриоперационной многопоточностью torch.
+# Изображения уменьшаются с сохранением пропорций, а в один тензор попадают только
+# изображения одного размера: кадры с другой ориентацией или соотношением сторон
+# идут отдельными пакетами, а не растягиваются (растяжение искажало бы градиенты,
+# размытие и гистограммы).
+# Нужен для пакетной обработки целых тестовых сессий; в интерактивном пути бота
+# используется обычный Image.analyze.
+#
+# Бэкенд необязательный: без torch/kornia is_available() возвращает False.
+#
+# Запуск из консоли (RAW декодируются в полном качестве, см. image_analyz.image_io):
+#     python -m image_analyz.batch_backend photo1.jpg photo2.dng ...
+
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+
+from image_analyz.image_io import decode_file
+
+try:
+    import torch
+    import kornia
+except ImportError:  # torch/kornia не установлены - бэкенд просто недоступен
+    torch = None
+    kornia = None
+
+BATCH_MAX_SIDE = 1024  # Большая сторона изображений в пакете
+BATCH_SIZE = 16  # Сколько изображений обрабатывается одним тензором
+HIST_BINS = 256
+TORCH_THREADS = int(os.getenv("BATCH_TORCH_THREADS", os.cpu_count() or 1))
+NOISE_MAX_STD = 25  # Нормировка быстрой оценки шума по всему кадру (см. analyze_batch)
+
+_threads_configured = False
+
+
+def is_available():
+    """Доступен ли пакетный бэкенд (установлены ли torch и kornia)."""
+    return torch is not None and kornia is not None
+
+
+def _require_backend():
+    if not is_available():
+        raise RuntimeError(
+            "Пакетный бэкенд недоступен: установите torch и kornia (pip install kornia)"
+        )
+    global _threads_configured
+    if not _threads_configured:
+        torch.set_num_threads(TORCH_THREADS)
+        _threads_configured = True
+
+
+def _scaled_size(image, max_side):
+    """Размер (w, h) изображения в пакете: пропорции сохраняются, большая сторона не больше max_side."""
+    h, w = image.shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def stack_images(images, max_side=BATCH_MAX_SIDE):
+    """
+    Складывает BGR uint8 изображения в тензор (B, 3, H, W) float32 RGB в диапазоне [0, 1].
+    Изображения уменьшаются с сохранением пропорций и после этого должны совпадать по размеру
+    (см. _group_by_size).
+    """
+    _require_backend()
+    sizes = {_scaled_size(image, max_side) for image in images}
+    if len(sizes) != 1:
+        raise ValueError(f"Изображения пакета разного размера после масштабирования: {sorted(sizes)}")
+    size = sizes.pop()
+    batch = np.stack([
+        image if (image.shape[1], image.shape[0]) == size
+        else cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        for image in images
+    ])
+    tensor = torch.from_numpy(batch).permute(0, 3, 1, 2).float().div_(255.0)
+    return kornia.color.bgr_to_rgb(tensor)
+
+
+def compute_batch_features(tensor):
+    """
+    Общие для метрик операции над пакетом:
+    - gray: (B, 1, H, W) оттенки серого
+    - sobel: (B, 1, H, W) модуль градиента Собеля
+    - blurred: (B, 1, H, W) размытие по Гауссу 5x5
+    - histograms: (B, HIST_BINS) гистограммы яркости
+    """
+    _require_backend()
+    with torch.inference_mode():
+        gray = kornia.color.rgb_to_grayscale(tensor)
+        sobel = kornia.filters.sobel(gray)
+        blurred = kornia.filters.gaussian_blur2d(gray, (5, 5), (1.1, 1.1))
+
+        # Гистограммы всех изображений одним bincount: смещаем индексы бинов на номер изображения
+        n = gray.shape[0]
+        bins = (gray.flatten(1) * (HIST_BINS - 1)).round_().long()
+        bins += torch.arange(n).unsqueeze(1) * HIST_BINS
+        histograms = torch.bincount(bins.flatten(), minlength=n * HIST_BINS).view(n, HIST_BINS)
+
+    return {"gray": gray, "sobel": sobel, "blurred": blurred, "histograms": histograms}
+
+
+def _group_by_size(images, max_side, batch_size):
+    """Пакеты индексов изображений: в пакете - изображения одного размера после масштабирования."""
+    groups = {}
+    for index, image in enumerate(images):
+        groups.setdefault(_scaled_size(image, max_side), []).append(index)
+    for indices in groups.values():
+        for start in range(0, len(indices), batch_size):
+            yield indices[start:start + batch_size]
+
+
+def analyze_batch(images, max_side=BATCH_MAX_SIDE, batch_size=BATCH_SIZE):
+    """
+    Пакетные оценки для списка BGR изображений.
+    Возвращает список словарей (по одному на изображение, в порядке images):
+    - noise: быстрая оценка шума 0-10 по всему кадру (10 - сильный шум); грубее плиточной
+      calculate_noise, т.к. учитывает и текстуру, но подходит для сравнения кадров одной сессии
+    - edge_energy: средний модуль градиента (косвенная мера резкости)
+    - contrast_ratio: отношение max/min яркости по гистограмме
+    - mean_luminance: средняя яркость 0-255
+    """
+    _require_backend()
+    results = [None] * len(images)
+    levels = torch.arange(HIST_BINS, dtype=torch.float64)
+
+    for indices in _group_by_size(images, max_side, batch_size):
+        features = compute_batch_features(stack_images([images[index] for index in indices], max_side))
+        with torch.inference_mode():
+            noise_std = (features["gray"] - features["blurred"]).abs().mul_(255).flatten(1).std(dim=1)
+            edge_energy = features["sobel"].mul(255).flatten(1).mean(dim=1)
+            hist = features["histograms"].double()
+            mean_luminance = (hist @ levels) / hist.sum(dim=1)
+
+        for i, index in enumerate(indices):
+            present = torch.nonzero(hist[i]).flatten()
+            min_val = max(int(present[0]), 1) if present.numel() else 1
+            max_val = int(present[-1]) if present.numel() else 0
+            results[index] = {
+                "noise": float(min(10.0, noise_std[i].item() / NOISE_MAX_STD * 10)),
+                "edge_energy": float(edge_energy[i]),
+                "contrast_ratio": max_val / min_val,
+                "mean_luminance": float(mean_luminance[i]),
+            }
+
+    return results
+
+
+def main(paths):
+    images = []
+    for path in paths:
+        image = decode_file(path, raw_mode="full")
+        if image is None:
+            print(f"Не удалось загрузить {path}", file=sys.stderr)
+            continue
+        images.append((path, image))
+
+    if not images:
+        return 1
+
+    for (path, _), result in zip(images, analyze_batch([image for _, image in images])):
+        print(json.dumps({"photo": path, **result}, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
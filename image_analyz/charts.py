@@ -0,0 +1,48 @@
+import io
+import os
+
+# Создание диаграмм и их сохранение в память вместо временных файлов.
+# Формат и разрешение задаются в окружении:
+# - CHART_FORMAT  - png (по умолчанию), webp или jpeg (webp и jpeg кодируются через Pillow)
+# - CHART_DPI     - разрешение всех диаграмм; если не задано, у каждой диаграммы своё
+# - CHART_QUALITY - качество webp/jpeg (1-100)
+
+CHART_FORMATS = {"png": "png", "webp": "webp", "jpeg": "jpg", "jpg": "jpg"}
+
+CHART_FORMAT = os.getenv("CHART_FORMAT", "png").lower()
+if CHART_FORMAT not in CHART_FORMATS:
+    raise ValueError(f"CHART_FORMAT: ожидается один из {sorted(CHART_FORMATS)}, получено {CHART_FORMAT!r}")
+CHART_DPI = int(os.getenv("CHART_DPI", "0") or 0) or None
+CHART_QUALITY = int(os.getenv("CHART_QUALITY", "85"))
+
+
+def chart_filename(name="chart"):
+    """Имя файла диаграммы с расширением текущего формата (для отправки в Telegram)."""
+    return f"{name}.{CHART_FORMATS[CHART_FORMAT]}"
+
+
+def new_figure(figsize):
+    """
+    Фигура matplotlib с холстом Agg, не зарегистрированная в pyplot.
+    Такие фигуры не делят глобальное состояние, поэтому разные фигуры
+    можно рисовать одновременно в разных потоках.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg  # Тяжёлый импорт: при первом графике или прогреве
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def save_chart(fig, dpi=300):
+    """
+    Кодирует фигуру в байты в формате CHART_FORMAT.
+    dpi - разрешение по умолчанию, если не задан CHART_DPI.
+    """
+    options = {}
+    if CHART_FORMAT != "png":
+        options["pil_kwargs"] = {"quality": CHART_QUALITY}
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=CHART_FORMAT, bbox_inches="tight", dpi=CHART_DPI or dpi, **options)
+    return buffer.getvalue()
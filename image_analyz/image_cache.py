@@ -0,0 +1,75 @@
+import threading
+import weakref
+from collections import namedtuple
+from functools import wraps
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# Все кэши по имени: для статистики попаданий (см. cache_stats)
+_caches = {}
+
+
+def register_cache(name, cached_func):
+    """Регистрирует функцию с cache_info() (per_image_cache или functools.lru_cache)."""
+    _caches[name] = cached_func
+
+
+def cache_stats():
+    """{имя кэша: CacheInfo} для всех зарегистрированных кэшей."""
+    return {name: func.cache_info() for name, func in _caches.items()}
+
+
+class _Entry:
+    __slots__ = ("ref", "lock", "result", "ready")
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.lock = threading.Lock()
+        self.result = None
+        self.ready = False
+
+
+def per_image_cache(func):
+    """
+    Запоминает результат func(image) пока жив сам массив изображения.
+
+    Нужен, когда несколько метрик строятся на одном и том же тяжёлом расчёте:
+    первая метрика считает, остальные берут готовый результат. Запись удаляется
+    вместе с изображением (через weakref), так что кэш не держит память.
+    Потокобезопасен: параллельные вызовы для одного изображения ждут первый расчёт.
+    """
+    entries = {}
+    stats = {"hits": 0, "misses": 0}
+    entries_lock = threading.RLock()  # RLock: drop() может сработать при сборке мусора внутри блокировки
+
+    @wraps(func)
+    def wrapper(image):
+        key = id(image)
+        with entries_lock:
+            entry = entries.get(key)
+            if entry is None or entry.ref() is not image:
+
+                def drop(ref, key=key):
+                    with entries_lock:
+                        if key in entries and entries[key].ref is ref:
+                            del entries[key]
+
+                entry = _Entry(weakref.ref(image, drop))
+                entries[key] = entry
+
+        with entry.lock:
+            if entry.ready:
+                stats["hits"] += 1
+            else:
+                stats["misses"] += 1
+                entry.result = func(image)
+                entry.ready = True
+            return entry.result
+
+    def cache_info():
+        with entries_lock:
+            return CacheInfo(stats["hits"], stats["misses"], None, len(entries))
+
+    wrapper.cache_info = cache_info
+    register_cache(f"{func.__module__}.{func.__name__}", wrapper)
+    return wrapper
@@ -0,0 +1,190 @@
+import mmap
+import os
+import struct
+
+import cv2
+import numpy as np
+
+try:
+    from pillow_heif import open_heif
+except ImportError:  # pillow-heif не установлен - HEIC/HEIF не декодируются
+    open_heif = None
+
+try:
+    import rawpy
+except ImportError:  # rawpy не установлен - RAW не декодируются
+    rawpy = None
+
+# Декодирование загруженных фото в BGR uint8 (формат, с которым работают метрики).
+# Файл декодируется прямо с диска, без чтения в память целиком: cv2.imread для
+# JPEG, PNG, WebP и TIFF (16-битные TIFF из RAW-конвертеров приводятся к 8 битам),
+# pillow-heif для HEIC/HEIF (pip install pillow-heif). Если cv2.imread не открыл
+# путь (например, не-ASCII путь в Windows), файл отображается в память (mmap)
+# и декодируется из неё cv2.imdecode - тоже без копии.
+#
+# RAW (DNG, CR2/CR3, NEF, ARW, ORF, RW2, RAF и др.) декодируются через rawpy/LibRaw
+# (pip install rawpy) с балансом белого камеры в sRGB. Режим демозаики (RAW_DEMOSAIC):
+# - half - половинное разрешение, каждый квадрат 2x2 байеровской матрицы даёт один
+#   пиксель без интерполяции; самый быстрый, используется ботом по умолчанию;
+# - linear - полное разрешение с билинейной демозаикой;
+# - full - полное разрешение с AHD, для пакетной обработки.
+# cv2.imread открывает DNG и прочие TIFF-подобные RAW как обычный TIFF и отдаёт
+# встроенное превью, поэтому RAW распознаются до cv2.imread: по сигнатуре, а у
+# TIFF-подобных - по расширению имени файла или по тегам TIFF (DNGVersion, данные
+# сенсора CFA/LinearRaw, маркер CR2). Распознанный RAW без rawpy не анализируется
+# по превью, а отклоняется с ошибкой.
+
+RAW_DEMOSAIC = os.getenv("RAW_DEMOSAIC", "half")
+RAW_MODES = ("half", "linear", "full")
+
+# Расширения RAW-файлов: Telegram часто присылает их с MIME application/octet-stream
+RAW_EXTENSIONS = {
+    ".dng", ".cr2", ".cr3", ".crw", ".nef", ".nrw", ".arw", ".srf", ".sr2",
+    ".orf", ".rw2", ".raf", ".pef", ".srw", ".x3f", ".3fr", ".iiq", ".rwl", ".mrw",
+}
+
+# Бренды контейнера ISO BMFF (байты 8-12 заголовка) у HEIC/HEIF
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"hevm", b"hevs", b"mif1", b"msf1"}
+# Сигнатуры RAW в начале файла. TIFF-подобные (II*, MM*) - это и DNG/CR2/NEF/ARW,
+# и обычные TIFF: их различает сам LibRaw
+RAW_SIGNATURES = (b"II*\x00", b"MM\x00*", b"IIRO", b"IIRS", b"MMOR", b"IIU\x00", b"FUJIFILM")
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*")
+TIFF_DNG_VERSION = 0xC612
+TIFF_PHOTOMETRIC = 262
+TIFF_SUB_IFDS = 330
+RAW_PHOTOMETRIC = {32803, 34892}  # CFA (байеровская матрица) и LinearRaw
+MAX_IFDS = 16  # Сколько IFD просматривать в поисках признаков RAW
+
+
+def _read_header(path):
+    with open(path, "rb") as f:
+        return f.read(16)
+
+
+def is_raw_name(file_name):
+    """Похоже ли имя файла на RAW (по расширению)."""
+    return os.path.splitext(file_name or "")[1].lower() in RAW_EXTENSIONS
+
+
+def raw_supported():
+    """Можно ли декодировать RAW (установлен ли rawpy)."""
+    return rawpy is not None
+
+
+def _is_heif_header(header):
+    return header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS
+
+
+def _is_raw_header(header):
+    return header.startswith(RAW_SIGNATURES) or (header[4:8] == b"ftyp" and header[8:12] == b"crx ")
+
+
+def _is_tiff_raw(path, header):
+    """Есть ли в TIFF признаки RAW: маркер CR2, тег DNGVersion или IFD с данными сенсора."""
+    if header[8:10] == b"CR":
+        return True
+    if len(header) < 8:  # Обрезанный файл: IFD нет
+        return False
+    order = "<" if header.startswith(b"II") else ">"
+    with open(path, "rb") as f:
+        pending, seen = [struct.unpack(order + "I", header[4:8])[0]], set()
+        while pending and len(seen) < MAX_IFDS:
+            offset = pending.pop()
+            if not offset or offset in seen:
+                continue
+            seen.add(offset)
+            f.seek(offset)
+            data = f.read(2)
+            if len(data) < 2:
+                continue
+            count = struct.unpack(order + "H", data)[0]
+            entries = f.read(count * 12 + 4)
+            for i in range(min(count, len(entries) // 12)):
+                tag, kind, values, value = struct.unpack(order + "HHI4s", entries[i * 12:i * 12 + 12])
+                if tag == TIFF_DNG_VERSION:
+                    return True
+                if tag == TIFF_PHOTOMETRIC:
+                    if struct.unpack(order + "H", value[:2])[0] in RAW_PHOTOMETRIC:
+                        return True
+                elif tag == TIFF_SUB_IFDS and kind in (4, 13):
+                    # Одно смещение хранится прямо в записи, несколько - по смещению
+                    if values == 1:
+                        pending.append(struct.unpack(order + "I", value)[0])
+                    elif values <= MAX_IFDS:
+                        f.seek(struct.unpack(order + "I", value)[0])
+                        offsets = f.read(4 * values)
+                        count_read = len(offsets) // 4
+                        pending.extend(struct.unpack(order + "I" * count_read, offsets[:count_read * 4]))
+            if len(entries) >= count * 12 + 4:
+                pending.append(struct.unpack(order + "I", entries[count * 12:count * 12 + 4])[0])
+    return False
+
+
+def _decode_raw(path, mode):
+    """
+    RAW в BGR uint8 или None, если LibRaw не смог его прочитать: формат не поддерживается
+    (например, обычный TIFF), файл обрезан или повреждён.
+    """
+    if mode not in RAW_MODES:
+        raise ValueError(f"Неизвестный режим демозаики RAW: {mode} (доступны: {', '.join(RAW_MODES)})")
+    params = {"use_camera_wb": True, "output_bps": 8}
+    if mode == "half":
+        params["half_size"] = True
+    else:
+        params["demosaic_algorithm"] = (
+            rawpy.DemosaicAlgorithm.LINEAR if mode == "linear" else rawpy.DemosaicAlgorithm.AHD
+        )
+    try:
+        with rawpy.imread(path) as raw:
+            rgb = raw.postprocess(**params)
+    except rawpy.LibRawError:  # LibRawFileUnsupportedError, LibRawIOError, LibRawDataError и др.
+        return None
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def _decode_heif(path):
+    if open_heif is None:
+        raise ValueError("Формат HEIC не поддерживается: не установлен pillow-heif")
+    image = np.asarray(open_heif(path, convert_hdr_to_8bit=True))
+    return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR if image.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+
+
+def _decode_mmap(path):
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            buffer = np.frombuffer(mapped, dtype=np.uint8)
+            try:
+                return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            finally:
+                del buffer  # mmap нельзя закрыть, пока на него ссылается массив
+
+
+def decode_file(path, raw_mode=None, file_name=None):
+    """
+    Изображение BGR из файла или None, если формат не распознан.
+    raw_mode - режим демозаики RAW (half, linear, full), по умолчанию RAW_DEMOSAIC.
+    file_name - исходное имя файла, если path его не сохраняет (временный файл, хранилище).
+    Для распознанного RAW без rawpy или не поддержанного LibRaw - ValueError.
+    """
+    header = _read_header(path)
+    if _is_heif_header(header):
+        return _decode_heif(path)
+    if _is_raw_header(header):
+        image = _decode_raw(path, raw_mode or RAW_DEMOSAIC) if rawpy is not None else None
+        if image is not None:
+            return image
+        # TIFF-подобный заголовок бывает и у обычного TIFF: он декодируется cv2.imread ниже
+        if (
+            not header.startswith(TIFF_SIGNATURES)
+            or is_raw_name(file_name or path)
+            or _is_tiff_raw(path, header)
+        ):
+            if rawpy is None:
+                raise ValueError("Формат RAW не поддерживается: не установлен rawpy")
+            raise ValueError("Формат RAW не поддерживается LibRaw")
+    image = cv2.imread(path)
+    if image is None:
+        image = _decode_mmap(path)
+    return image
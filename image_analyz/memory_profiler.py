@@ -0,0 +1,189 @@
+import heapq
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+# Учёт памяти по метрикам: пик tracemalloc, прирост RSS и самые крупные выделения.
+# Включается переменной окружения MEMORY_PROFILING=1 или командой /memory on.
+# tracemalloc глобален для процесса: reset_peak() одного замера обнулил бы пик другого,
+# а stop() посреди чужого замера сломал бы его снимки. Поэтому замеряемые анализы идут
+# по одному (tracing()), а метрики внутри анализа - по очереди в его потоке. Выделения
+# вне анализов (диаграммы, декодирование других фото) в пики всё же попадают.
+
+logger = logging.getLogger(__name__)
+
+TOP_ALLOCATIONS = 5  # Сколько крупнейших выделений памяти запоминать для метрики
+PEAK_POLL_INTERVAL = 0.005  # Как часто (сек) проверять, не вырос ли пик памяти
+PEAK_SNAPSHOT_GROWTH = 1.1  # Снимок делается, когда пик вырос хотя бы на 10%
+MAX_REPORTS = 20  # Сколько последних отчётов хранить для команды /memory
+
+_enabled = os.getenv("MEMORY_PROFILING") == "1"
+_reports = deque(maxlen=MAX_REPORTS)
+_reports_lock = threading.Lock()
+_tracing_lock = threading.RLock()  # Один сеанс tracemalloc на процесс; RLock - для вложенных track()
+
+
+def is_enabled():
+    return _enabled
+
+
+def set_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def get_recent_reports():
+    """Последние отчёты (новые в конце)."""
+    with _reports_lock:
+        return list(_reports)
+
+
+def _current_rss():
+    """Текущий RSS процесса в байтах."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return _peak_rss()
+
+
+def _peak_rss():
+    """Пиковый RSS процесса в байтах (ru_maxrss в Linux - в килобайтах)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _format_size(size):
+    for unit in ("Б", "КБ", "МБ"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+@contextmanager
+def tracing():
+    """Сеанс tracemalloc: сеансы разных потоков идут по очереди, stop() - только в конце своего."""
+    with _tracing_lock:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if started_here:
+                tracemalloc.stop()
+
+
+class _PeakSampler(threading.Thread):
+    """
+    Фоновый поток, который снимает tracemalloc-снимок в момент роста пика.
+    Так видны крупные массивы, которые метрика выделила и уже освободила к концу работы.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stop_event = threading.Event()
+        self.snapshot = None
+        self.snapshot_size = 0
+
+    def take_snapshot(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.snapshot_size * PEAK_SNAPSHOT_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = current
+
+    def run(self):
+        while not self.stop_event.wait(PEAK_POLL_INTERVAL):
+            self.take_snapshot()
+
+
+class MetricMemoryTracker:
+    """Собирает замеры памяти по каждой метрике одного анализа."""
+
+    def __init__(self, image_shape=None):
+        self.image_shape = image_shape
+        self.records = []
+
+    @contextmanager
+    def track(self, name):
+        with tracing():
+            tracemalloc.reset_peak()
+            traced_before, _ = tracemalloc.get_traced_memory()
+            rss_before = _current_rss()
+            peak_rss_before = _peak_rss()
+            sampler = _PeakSampler()
+            sampler.start()
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                elapsed = time.perf_counter() - started
+                sampler.stop_event.set()
+                sampler.join()
+                sampler.take_snapshot()
+                _, traced_peak = tracemalloc.get_traced_memory()
+
+                largest = []
+                if sampler.snapshot is not None:
+                    # Служебные выделения самого сэмплера не интересны
+                    snapshot = sampler.snapshot.filter_traces([
+                        tracemalloc.Filter(False, threading.__file__),
+                        tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, __file__),
+                    ])
+                    for trace in heapq.nlargest(TOP_ALLOCATIONS, snapshot.traces, key=lambda t: t.size):
+                        frame = trace.traceback[0]
+                        largest.append((f"{os.path.basename(frame.filename)}:{frame.lineno}", trace.size))
+
+                self.records.append({
+                    "metric": name,
+                    "seconds": elapsed,
+                    "traced_peak": max(0, traced_peak - traced_before),
+                    "rss_delta": _current_rss() - rss_before,
+                    "peak_rss_delta": _peak_rss() - peak_rss_before,
+                    "largest": largest,
+                })
+
+    def finish(self):
+        """Пишет отчёт в лог и сохраняет его для команды /memory."""
+        report = {
+            "time": time.time(),
+            "image_shape": self.image_shape,
+            "metrics": sorted(self.records, key=lambda r: r["traced_peak"], reverse=True),
+        }
+        with _reports_lock:
+            _reports.append(report)
+        for record in report["metrics"]:
+            logger.info(
+                "memory %s: peak %s, rss %+d B, peak rss %+d B, %.3f s, largest: %s",
+                record["metric"],
+                _format_size(record["traced_peak"]),
+                record["rss_delta"],
+                record["peak_rss_delta"],
+                record["seconds"],
+                ", ".join(f"{where} {_format_size(size)}" for where, size in record["largest"]),
+            )
+        return report
+
+
+def format_report(report):
+    """Текстовое представление отчёта для сообщения в Telegram."""
+    lines = [
+        "Память по метрикам"
+        + (f" (изображение {report['image_shape']})" if report["image_shape"] else "")
+        + ":"
+    ]
+    for record in report["metrics"]:
+        lines.append(
+            f"• {record['metric']}: пик {_format_size(record['traced_peak'])}, "
+            f"RSS {_format_size(record['rss_delta'])}, "
+            f"пик RSS +{_format_size(record['peak_rss_delta'])}, {record['seconds']:.2f} с"
+        )
+        for where, size in record["largest"][:3]:
+            lines.append(f"    {where}: {_format_size(size)}")
+    return "\n".join(lines)
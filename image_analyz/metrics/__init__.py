@@ -1,10 +1,40 @@
+from functools import lru_cache
 from typing import Dict, Callable
 import importlib
 import os
 import glob
 
 
+def depends_on(*metric_names):
+    """
+    Объявляет, что метрика считается только после указанных метрик (имена из реестра).
+    Нужно, когда метрики делят один расчёт через per_image_cache: зависимая метрика
+    берёт готовый результат, а не ждёт его в соседнем потоке.
+    """
+    def decorator(func):
+        func.depends_on = metric_names
+        return func
+    return decorator
+
+
+def version(number):
+    """
+    Версия реализации метрики (по умолчанию 1). Увеличивается, когда меняются
+    значения метрики: рейтинги с более старой версией пересчитывает data.backfill.
+    """
+    def decorator(func):
+        func.version = number
+        return func
+    return decorator
+
+
 def get_metrics() -> Dict[str, Callable]:
+    # Реестр строится один раз (при прогреве или первом анализе), дальше отдаётся копия
+    return dict(_load_metrics())
+
+
+@lru_cache(maxsize=None)
+def _load_metrics() -> Dict[str, Callable]:
     metrics = {}
     # Получаем все .py файлы в папке metrics, кроме __init__.py
     metric_files = glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))
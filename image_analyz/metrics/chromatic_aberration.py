@@ -1,74 +1,195 @@
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
-import tempfile
 
-def calculate_chromatic_aberration(image_data):
-    if image_data is None or image_data.size == 0:
-        return {'chromatic_aberration': 0.0, 'aberration_chart': None}
+from image_analyz.charts import new_figure, save_chart
+from image_analyz.image_cache import per_image_cache
+from image_analyz.metrics import version
+
+TILE_SIZE = 64  # Сторона плитки для фазовой корреляции, пиксели исходного кадра
+MAX_TILES = 300  # Сколько плиток максимум анализируем
+OUTER_RADIUS = 0.6  # С какого нормированного радиуса плитка считается "угловой"
+OUTER_SHARE = 0.7  # Доля плиток, отбираемых во внешней (угловой) области
+MIN_EDGE_ENERGY = 20.0  # Минимальный средний градиент в плитке, чтобы в ней был контрастный край
+MIN_RESPONSE = 0.5  # Минимальный отклик фазовой корреляции (у несвязанных каналов он ~0.1-0.35)
+RADIUS_BINS = 5  # На сколько колец по радиусу делим кадр для профиля смещения
+
+# Смещение каналов масштабируется к кадру 4000x3000 (диагональ 5000 px),
+# чтобы оценка не зависела от разрешения
+REFERENCE_DIAGONAL = 5000.0
+MAX_SHIFT = 2.0  # Смещение (px, после масштабирования), при котором оценка падает до 0
+# Оценка, когда измерять нечего (пустое изображение, нет контрастных плиток): аберрации
+# не обнаружено, как у бликов (glare). Одна и та же во всех таких случаях, чтобы рейтинг
+# не зависел от того, на каком шаге не нашлось данных
+NO_ABERRATION_SCORE = 10.0
+
+
+def _select_tiles(image_data):
+    """
+    Отбирает контрастные плитки, большую часть - ближе к углам кадра.
+    Энергия краёв считается на зелёном канале, прореженном так, что на плитку
+    приходится 8x8 отсчётов, поэтому выбор плиток почти ничего не стоит.
+    """
+    h, w = image_data.shape[:2]
+    n_ty, n_tx = h // TILE_SIZE, w // TILE_SIZE
+    if n_ty == 0 or n_tx == 0:
+        return []
+
+    step = TILE_SIZE // 8
+    green = image_data[: n_ty * TILE_SIZE : step, : n_tx * TILE_SIZE : step, 1].astype(np.float32)
+    magnitude = cv2.magnitude(
+        cv2.Sobel(green, cv2.CV_32F, 1, 0, ksize=3),
+        cv2.Sobel(green, cv2.CV_32F, 0, 1, ksize=3),
+    )
+    energy = magnitude.reshape(n_ty, 8, n_tx, 8).mean(axis=(1, 3))
+
+    ty, tx = np.indices((n_ty, n_tx))
+    cy = (ty + 0.5) * TILE_SIZE - h / 2
+    cx = (tx + 0.5) * TILE_SIZE - w / 2
+    radius = np.hypot(cx, cy) / np.hypot(w / 2, h / 2)
+
+    candidates = energy >= MIN_EDGE_ENERGY
+    selected = []
+    for region, quota in (
+        (radius >= OUTER_RADIUS, int(MAX_TILES * OUTER_SHARE)),
+        (radius < OUTER_RADIUS, MAX_TILES - int(MAX_TILES * OUTER_SHARE)),
+    ):
+        idx = np.flatnonzero(candidates & region)
+        idx = idx[np.argsort(energy.ravel()[idx])[::-1][:quota]]
+        selected.extend(idx.tolist())
+
+    return [(int(i // n_tx) * TILE_SIZE, int(i % n_tx) * TILE_SIZE) for i in selected]
+
+
+@per_image_cache
+def analyze_chromatic_aberration(image_data):
+    """
+    Оценивает латеральную хроматическую аберрацию.
+
+    На отобранных плитках фазовой корреляцией с субпиксельной точностью
+    измеряется сдвиг каналов R и B относительно G. Сдвиг проецируется на
+    направление от центра кадра (латеральная ХА радиальна).
+
+    Возвращает:
+    - chromatic_aberration: оценка 0-10 (10 - аберрации нет)
+    - tiles: [(y, x, радиус, сдвиг R-G, сдвиг B-G)] по плиткам
+    - radius_bins: центры колец по нормированному радиусу
+    - shift_rg / shift_bg: средний |радиальный сдвиг| в px для каждого кольца (None, если плиток нет)
+    """
+    empty = {
+        "chromatic_aberration": NO_ABERRATION_SCORE,
+        "tiles": [],
+        "radius_bins": [],
+        "shift_rg": [],
+        "shift_bg": [],
+    }
+    if image_data is None or image_data.size == 0 or image_data.ndim != 3:
+        return empty
 
-    # Преобразуем из BGR (OpenCV) в RGB
-    image_rgb = cv2.cvtColor(image_data, cv2.COLOR_BGR2RGB)
+    h, w = image_data.shape[:2]
+    half_diagonal = np.hypot(w / 2, h / 2)
+    window = cv2.createHanningWindow((TILE_SIZE, TILE_SIZE), cv2.CV_32F)
 
-    # Разделяем каналы
-    r = image_rgb[:, :, 0]
-    g = image_rgb[:, :, 1]
-    b = image_rgb[:, :, 2]
+    tiles = []
+    for y, x in _select_tiles(image_data):
+        roi = image_data[y:y + TILE_SIZE, x:x + TILE_SIZE].astype(np.float32)
+        b, g, r = roi[:, :, 0], roi[:, :, 1], roi[:, :, 2]
+        (rdx, rdy), r_response = cv2.phaseCorrelate(g, r, window)
+        (bdx, bdy), b_response = cv2.phaseCorrelate(g, b, window)
+        if min(r_response, b_response) < MIN_RESPONSE:
+            continue
 
-    # Детектируем границы на каждом канале
-    def get_edges(channel):
-        return cv2.Canny(channel, 100, 200)
+        # Единичный вектор от центра кадра к центру плитки
+        vx = x + TILE_SIZE / 2 - w / 2
+        vy = y + TILE_SIZE / 2 - h / 2
+        norm = np.hypot(vx, vy)
+        if norm < 1e-6:
+            continue
+        ux, uy = vx / norm, vy / norm
+        tiles.append((y, x, norm / half_diagonal, rdx * ux + rdy * uy, bdx * ux + bdy * uy))
 
-    r_edges = get_edges(r)
-    g_edges = get_edges(g)
-    b_edges = get_edges(b)
+    if not tiles:
+        return empty
 
-    # Вычисляем разницу между каналами только на границах
-    diff_rg = cv2.absdiff(r_edges, g_edges)
-    diff_rb = cv2.absdiff(r_edges, b_edges)
-    diff_gb = cv2.absdiff(g_edges, b_edges)
+    data = np.array([t[2:] for t in tiles])
+    edges = np.linspace(0, 1, RADIUS_BINS + 1)
+    bin_index = np.clip(np.digitize(data[:, 0], edges) - 1, 0, RADIUS_BINS - 1)
+    shift_rg, shift_bg = [], []
+    for i in range(RADIUS_BINS):
+        in_bin = data[bin_index == i]
+        shift_rg.append(float(np.mean(np.abs(in_bin[:, 1]))) if len(in_bin) else None)
+        shift_bg.append(float(np.mean(np.abs(in_bin[:, 2]))) if len(in_bin) else None)
+
+    # Итоговое смещение - по внешней области (там латеральная ХА максимальна)
+    outer = data[data[:, 0] >= OUTER_RADIUS]
+    if len(outer) == 0:
+        outer = data
+    shift = max(np.mean(np.abs(outer[:, 1])), np.mean(np.abs(outer[:, 2])))
+    scaled_shift = shift * REFERENCE_DIAGONAL / (2 * half_diagonal)
+    score = float(np.clip(10 - 10 * scaled_shift / MAX_SHIFT, 0, 10))
+
+    return {
+        "chromatic_aberration": score,
+        "tiles": tiles,
+        "radius_bins": (0.5 * (edges[:-1] + edges[1:])).tolist(),
+        "shift_rg": shift_rg,
+        "shift_bg": shift_bg,
+    }
+
+
+@version(2)  # 2 - фазовая корреляция на контрастных плитках
+def calculate_chromatic_aberration(image_data, with_chart=False):
+    """
+    Оценка хроматической аберрации и (при with_chart=True) изображение в байтах
+    с отмеченными плитками и профилем смещения каналов.
+    """
+    if image_data is None or image_data.size == 0:
+        return {'chromatic_aberration': NO_ABERRATION_SCORE, 'aberration_chart': None}
+
+    result = analyze_chromatic_aberration(image_data)
+    # В общем анализе нужна только оценка, визуализацию бот рисует отдельно
+    if not with_chart:
+        return {'chromatic_aberration': result["chromatic_aberration"], 'aberration_chart': None}
 
     # Создаем визуализацию
-    plt.figure(figsize=(12, 8))
-    
-    # Визуализация разницы между каналами
-    plt.subplot(2, 2, 1)
-    plt.imshow(cv2.cvtColor(image_data, cv2.COLOR_BGR2RGB))
-    plt.title('Исходное изображение')
-    plt.axis('off')
-    
-    plt.subplot(2, 2, 2)
-    plt.imshow(diff_rg, cmap='hot')
-    plt.title('Разница R-G каналов')
-    plt.colorbar()
-    plt.axis('off')
-    
-    plt.subplot(2, 2, 3)
-    plt.imshow(diff_rb, cmap='hot')
-    plt.title('Разница R-B каналов')
-    plt.colorbar()
-    plt.axis('off')
-    
-    plt.subplot(2, 2, 4)
-    plt.imshow(diff_gb, cmap='hot')
-    plt.title('Разница G-B каналов')
-    plt.colorbar()
-    plt.axis('off')
-
-    plt.tight_layout()
-    
-    # Сохраняем график во временный файл
-    aberration_chart_path = None
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-        plt.savefig(tmp.name, bbox_inches='tight', dpi=300)
-        plt.close()
-        aberration_chart_path = tmp.name
-
-    # Вычисляем метрику аберрации
-    aberration_score = (np.mean(diff_rg) + np.mean(diff_rb) + np.mean(diff_gb)) / 3.0
-    normalized_score = np.clip(10 - (aberration_score * 0.1), 0, 10)  # Нормализуем к шкале 0-10
+    from matplotlib.patches import Rectangle
+
+    fig = new_figure((12, 5))
+
+    # Уменьшенная копия кадра с отмеченными плитками
+    ax1 = fig.add_subplot(1, 2, 1)
+    h, w = image_data.shape[:2]
+    scale = min(1.0, 1024 / max(h, w))
+    preview = cv2.resize(image_data, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ax1.imshow(cv2.cvtColor(preview, cv2.COLOR_BGR2RGB))
+    for y, x, *_ in result["tiles"]:
+        ax1.add_patch(Rectangle(
+            (x * scale, y * scale), TILE_SIZE * scale, TILE_SIZE * scale,
+            fill=False, edgecolor='yellow', linewidth=0.5,
+        ))
+    ax1.set_title(f'Проанализированные участки ({len(result["tiles"])})')
+    ax1.axis('off')
+
+    # Смещение каналов в зависимости от расстояния до центра
+    ax2 = fig.add_subplot(1, 2, 2)
+    centers = result["radius_bins"]
+    for key, color, label in (("shift_rg", "red", "R относительно G"), ("shift_bg", "blue", "B относительно G")):
+        points = [(c, v) for c, v in zip(centers, result[key]) if v is not None]
+        if points:
+            ax2.plot(*zip(*points), marker="o", color=color, label=label)
+    ax2.set_xlabel('Расстояние от центра (0 - центр, 1 - угол)')
+    ax2.set_ylabel('Смещение канала, px')
+    ax2.set_title('Латеральная хроматическая аберрация')
+    ax2.set_xlim(0, 1)
+    ax2.grid(True)
+    if centers:
+        ax2.legend()
+
+    fig.tight_layout()
+
+    # Кодируем график в память
+    aberration_chart = save_chart(fig, dpi=300)
 
     return {
-        'chromatic_aberration': float(normalized_score),
-        'aberration_chart': aberration_chart_path
-    }
\ No newline at end of file
+        'chromatic_aberration': result["chromatic_aberration"],
+        'aberration_chart': aberration_chart
+    }
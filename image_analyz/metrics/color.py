@@ -1,6 +1,12 @@
+import os
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
+from image_analyz.image_cache import per_image_cache, register_cache
+from image_analyz.metrics import depends_on, version
+
 # Координаты патчей (4 строки x 6 столбцов)
 # В виде относительных координат (от 0 до 1)
 PATCH_GRID = (4, 6)
@@ -10,6 +16,19 @@ PATCH_GRID = (4, 6)
 # Патчи равномерно распределены, с небольшим отступом от краёв
 PATCH_MARGIN = 0.03  # 3% отступ от краёв
 
+# Сколько пикселей максимум читаем для средних по патчам (остальные пропускаются с шагом)
+MAX_SAMPLED_PIXELS = 1_000_000
+
+# Высота полосы, которой обходится кадр при подсчёте цветовой статистики
+STATS_STRIP_ROWS = 256
+
+# Эталонный снимок ColorChecker
+REFERENCE_IMAGE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "public",
+    "colorchecker-x-rite.png",
+)
+
 
 def get_patch_coords(img_shape, row, col):
     h, w = img_shape[:2]
@@ -24,47 +43,91 @@ def get_patch_coords(img_shape, row, col):
     return (int(y0 * h), int(y1 * h), int(x0 * w), int(x1 * w))
 
 
+def _grid_bounds(size, count):
+    """Границы патчей вдоль одной оси в пикселях (те же, что в get_patch_coords)."""
+    step = (1 - 2 * PATCH_MARGIN) / count
+    starts = PATCH_MARGIN + np.arange(count) * step
+    return (starts * size).astype(np.int64), ((starts + step) * size).astype(np.int64)
+
+
+def _block_sums(image, starts, stops, axis):
+    """
+    Суммы по отрезкам [start, stop) вдоль оси за один проход.
+    Изображение режется по уникальным границам через np.add.reduceat,
+    затем суммы отрезков собираются префиксными суммами (одномерный интеграл).
+    """
+    edges = np.unique(np.concatenate([starts, stops]))
+    region = image[(slice(None),) * axis + (slice(edges[0], edges[-1]),)]
+    # uint32 не переполняется: выборка ограничена MAX_SAMPLED_PIXELS пикселями
+    segments = np.add.reduceat(region, edges[:-1] - edges[0], axis=axis, dtype=np.uint32)
+
+    shape = list(segments.shape)
+    shape[axis] = 1
+    prefix = np.concatenate(
+        [np.zeros(shape, dtype=np.int64), np.cumsum(segments, axis=axis, dtype=np.int64)],
+        axis=axis,
+    )
+    first = np.take(prefix, np.searchsorted(edges, starts), axis=axis)
+    last = np.take(prefix, np.searchsorted(edges, stops), axis=axis)
+    return last - first
+
+
 def extract_patches(image):
     """
     Возвращает массив средних RGB-цветов для 24 патчей (4x6).
+    Средние считаются векторно, без цикла по патчам и без изменения размера изображения.
+    Большие изображения прореживаются с целым шагом, чтобы читать не больше MAX_SAMPLED_PIXELS.
     """
-    patches = []
-    for row in range(PATCH_GRID[0]):
-        for col in range(PATCH_GRID[1]):
-            y0, y1, x0, x1 = get_patch_coords(image.shape, row, col)
-            patch = image[y0:y1, x0:x1]
-            mean_color = patch.mean(axis=(0, 1))  # BGR
-            patches.append(mean_color[::-1])  # В RGB
-    return np.array(patches)  # shape (24, 3)
+    h, w = image.shape[:2]
+    step = max(1, int(np.ceil(np.sqrt(h * w / MAX_SAMPLED_PIXELS))))
+    sampled = image[::step, ::step]
 
+    # Пиксель с индексом k в прореженном изображении - это пиксель k*step исходного
+    n_rows, n_cols = PATCH_GRID
+    y0, y1 = (-(-bound // step) for bound in _grid_bounds(h, n_rows))
+    x0, x1 = (-(-bound // step) for bound in _grid_bounds(w, n_cols))
 
-def analyze_colorchecker(user_img_path, reference_img_path):
+    sums = _block_sums(_block_sums(sampled, y0, y1, axis=0), x0, x1, axis=1)  # (4, 6, 3)
+    counts = np.outer(y1 - y0, x1 - x0).astype(np.float64)
+    means = sums / np.maximum(counts, 1)[:, :, None]
+    return means[:, :, ::-1].reshape(-1, 3)  # BGR -> RGB, shape (24, 3)
+
+
+@lru_cache(maxsize=None)
+def load_reference_patches(reference_img_path=REFERENCE_IMAGE_PATH):
+    """
+    Средние цвета патчей эталона. Считаются один раз и переиспользуются.
+    """
+    ref_img = cv2.imread(reference_img_path)
+    if ref_img is None:
+        raise ValueError("Не удалось загрузить эталонное изображение!")
+    patches = extract_patches(ref_img)
+    patches.setflags(write=False)
+    return patches
+
+
+register_cache(f"{__name__}.load_reference_patches", load_reference_patches)
+
+
+def analyze_colorchecker(user_img, reference_img_path=REFERENCE_IMAGE_PATH):
     """
     Основная функция: сравнивает пользовательское фото с эталоном по colorchecker.
+    user_img - путь к файлу или уже загруженное BGR-изображение.
     Возвращает dict с метриками: white_balance, color_gamut, contrast_ratio.
     """
-    # Загружаем изображения
-    user_img = cv2.imread(user_img_path)
-    ref_img = cv2.imread(reference_img_path)
-    if user_img is None or ref_img is None:
+    # Загружаем изображение пользователя (если передан путь)
+    if isinstance(user_img, str):
+        user_img = cv2.imread(user_img)
+    if user_img is None:
         raise ValueError("Не удалось загрузить изображения!")
 
-    # Приводим к одному размеру (размеру эталона)
-    user_img = cv2.resize(user_img, (ref_img.shape[1], ref_img.shape[0]))
-
-    # Извлекаем патчи
+    # Патчи берутся в относительных координатах, поэтому фото не приводим к размеру эталона
     user_patches = extract_patches(user_img)
-    ref_patches = extract_patches(ref_img)
+    ref_patches = load_reference_patches(reference_img_path)
 
     # --- Баланс белого ---
-    # Серые патчи: последние 6 (нижний ряд)
-    user_gray = user_patches[18:24]
-    ref_gray = ref_patches[18:24]
-    # Средний цвет по каждому каналу
-    user_gray_mean = user_gray.mean(axis=0)
-    ref_gray_mean = ref_gray.mean(axis=0)
-    # Отклонение от эталона (1.0 = идеально)
-    white_balance = np.mean(user_gray_mean / (ref_gray_mean + 1e-8))
+    # Серые патчи (нижний ряд) относительно серых патчей эталона, как в методе 5
+    white_balance = _white_balance(user_patches, ref_patches)
 
     # --- Цветовой охват ---
     # Считаем площадь охвата патчей в RGB (можно в Convex Hull, но проще — среднее отклонение)
@@ -79,7 +142,7 @@ def analyze_colorchecker(user_img_path, reference_img_path):
     def luminance(rgb):
         return 0.2126 * rgb[0] + 0.7152 * rgb[1] + 0.0722 * rgb[2]
 
-    user_lums = np.array([luminance(rgb) for rgb in user_patches])
+    user_lums = luminance(user_patches.T)
     min_lum = user_lums.min()
     max_lum = user_lums.max()
     # Контрастность как отношение максимальной к минимальной яркости
@@ -92,72 +155,103 @@ def analyze_colorchecker(user_img_path, reference_img_path):
     }
 
 
-def calculate_color_gamut(image_data):
+@per_image_cache
+def compute_color_statistics(image_data):
     """
-    Оценивает цветовой охват в % от sRGB.
-    Упрощённый подход: сравниваем с "идеальным" sRGB изображением.
+    Считает все цветовые метрики метода 5 за один проход по uint8-изображению.
+
+    Изображение обходится полосами по STATS_STRIP_ROWS строк: для каждой полосы
+    накапливаются гистограммы каналов и min/max яркости. Широких (int64/float)
+    временных массивов размером с кадр не создаётся.
+    Результат кэшируется на время жизни изображения, поэтому
+    calculate_color_gamut, calculate_white_balance и calculate_contrast_ratio
+    используют один расчёт.
     """
-    # Конвертируем в RGB (OpenCV использует BGR)
-    rgb_img = cv2.cvtColor(image_data, cv2.COLOR_BGR2RGB)
+    channel_hist = np.zeros((3, 256), dtype=np.float64)
+    min_val, max_val = 255.0, 0.0
 
-    # Упрощённая оценка: сравниваем с "идеальным" белым (255, 255, 255)
-    white_pixel = np.array([255, 255, 255])
-    avg_color_diff = np.mean(np.abs(rgb_img - white_pixel)) / 255.0
+    for y in range(0, image_data.shape[0], STATS_STRIP_ROWS):
+        strip = image_data[y:y + STATS_STRIP_ROWS]
+        for channel in range(3):
+            channel_hist[channel] += cv2.calcHist([strip], [channel], None, [256], [0, 256]).ravel()
+        strip_min, strip_max, _, _ = cv2.minMaxLoc(cv2.cvtColor(strip, cv2.COLOR_BGR2GRAY))
+        min_val = min(min_val, strip_min)
+        max_val = max(max_val, strip_max)
 
-    # Чем меньше отличие, тем лучше охват (условная метрика)
-    coverage = 100 - (avg_color_diff * 100)
-    return coverage
+    levels = np.arange(256, dtype=np.float64)
+    channel_means = channel_hist @ levels / np.maximum(channel_hist.sum(axis=1), 1)  # BGR
+
+    return {
+        "color_gamut": _color_gamut(channel_means),
+        # Серые патчи сравниваются с эталоном ColorChecker (загружается один раз, см. warmup)
+        "white_balance": _white_balance(extract_patches(image_data), load_reference_patches()),
+        "contrast_ratio": _contrast_ratio(min_val, max_val),
+    }
 
 
-def calculate_white_balance(image_data):
+def _color_gamut(channel_means):
     """
-    Оценивает баланс белого по отклонению от нейтрального серого.
-    Использует серые патчи для оценки баланса белого.
-    Возвращает значение от 0 до 1, где:
-    - 1.0 означает идеальный баланс белого
-    - Значения < 1.0 указывают на отклонение от идеального баланса
+    Оценивает цветовой охват в % от sRGB.
+    Упрощённый подход: сравниваем с "идеальным" белым (255, 255, 255).
+    Среднее |255 - v| по всем каналам равно 255 - среднее значение канала.
     """
-    # Извлекаем патчи из изображения
-    patches = extract_patches(image_data)
+    avg_color_diff = (255.0 - np.mean(channel_means)) / 255.0
 
-    # Используем нижний ряд патчей (предполагается, что это серые патчи)
-    gray_patches = patches[18:24]
+    # Чем меньше отличие, тем лучше охват (условная метрика)
+    coverage = 100 - (avg_color_diff * 100)
+    return float(coverage)
 
-    # Вычисляем среднее значение для каждого канала RGB
-    mean_rgb = np.mean(gray_patches, axis=0)
 
-    # Идеальный серый цвет должен иметь равные значения R, G и B
-    # Вычисляем отклонение от идеального серого
-    max_channel = np.max(mean_rgb)
-    min_channel = np.min(mean_rgb)
+def _white_balance(patches, reference_patches):
+    """
+    Оценивает баланс белого по серым патчам (нижний ряд) относительно серых патчей эталона:
+    у эталонного снимка свой небольшой оттенок, и нейтральным считается совпадение с ним.
+    """
+    # Средний цвет серых патчей по каждому каналу RGB
+    mean_rgb = np.mean(patches[18:24], axis=0)
+    reference_rgb = np.mean(reference_patches[18:24], axis=0)
 
-    # Если все каналы равны, баланс белого идеальный (1.0)
-    # Чем больше разница между каналами, тем хуже баланс белого
-    if max_channel == 0:
+    # Если все каналы равны нулю, оценивать нечего: баланс считаем идеальным (1.0)
+    if np.max(mean_rgb) == 0:
         return 1.0
 
-    # Нормализуем разницу между каналами
+    # Доли каналов фото, поделённые на доли каналов эталона: у идеального баланса все равны
+    channels = (mean_rgb / mean_rgb.mean()) / (reference_rgb / max(reference_rgb.mean(), 1e-8) + 1e-8)
+    max_channel = np.max(channels)
+    min_channel = np.min(channels)
+
+    # Нормализуем разницу между каналами и преобразуем в оценку от 0 до 1
     channel_diff = (max_channel - min_channel) / max_channel
+    return float(1.0 - channel_diff)
 
-    # Преобразуем в оценку от 0 до 1
-    white_balance_score = 1.0 - channel_diff
 
-    return float(white_balance_score)
+def _contrast_ratio(min_val, max_val):
+    # Добавляем небольшую константу к минимальному значению, чтобы избежать деления на ноль
+    min_val = max(min_val, 1)
+    return float(max_val / min_val)
 
 
-def calculate_contrast_ratio(image):
-    """Рассчитывает контрастность изображения."""
-    # Преобразуем изображение в оттенки серого
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def calculate_color_gamut(image_data):
+    """
+    Оценивает цветовой охват в % от sRGB.
+    Упрощённый подход: сравниваем с "идеальным" sRGB изображением.
+    """
+    return compute_color_statistics(image_data)["color_gamut"]
 
-    # Находим максимальное и минимальное значения яркости
-    max_val = np.max(gray)
-    min_val = np.min(gray)
 
-    # Добавляем небольшую константу к минимальному значению, чтобы избежать деления на ноль
-    min_val = max(min_val, 1)
+@version(2)  # 2 - серые патчи сравниваются с серыми патчами эталона ColorChecker
+@depends_on("color_gamut")  # Общий расчёт compute_color_statistics
+def calculate_white_balance(image_data):
+    """
+    Оценивает баланс белого по отклонению серых патчей от серых патчей эталона ColorChecker.
+    Возвращает значение от 0 до 1, где:
+    - 1.0 означает идеальный баланс белого
+    - Значения < 1.0 указывают на отклонение от идеального баланса
+    """
+    return compute_color_statistics(image_data)["white_balance"]
 
-    # Рассчитываем контрастность
-    contrast_ratio = max_val / min_val
 
-    return contrast_ratio
+@depends_on("color_gamut")  # Общий расчёт compute_color_statistics
+def calculate_contrast_ratio(image):
+    """Рассчитывает контрастность изображения (max/min яркости в оттенках серого)."""
+    return compute_color_statistics(image)["contrast_ratio"]
@@ -1,5 +1,113 @@
-import random
+import cv2
+import numpy as np
 
+from image_analyz.metrics import version
 
+ANALYSIS_MAX_SIDE = 512  # Размер большей стороны плоскости яркости, на которой ищутся блики
+HIGHLIGHT_LEVEL = 250  # Порог яркости (0-255) для пересвеченных областей
+MIN_SOURCE_AREA = 4  # Минимальная площадь источника блика в пикселях уменьшенной плоскости
+MAX_SOURCES = 20  # Сколько самых крупных источников анализируем
+MIN_RING_WIDTH = 4  # Минимальная ширина кольца вокруг источника
+MAX_HIGHLIGHT_FRACTION = 0.05  # Доля пересвета в кадре, при которой штраф за площадь максимален
+
+
+def _luminance_plane(image_data):
+    """
+    Плоскость яркости с большей стороной не более ANALYSIS_MAX_SIDE.
+    Сначала кадр прореживается целым шагом (читается лишь часть пикселей),
+    затем доводится до нужного размера через INTER_AREA.
+    """
+    h, w = image_data.shape[:2]
+    step = max(1, max(h, w) // (2 * ANALYSIS_MAX_SIDE))
+    small = image_data[::step, ::step]
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else np.ascontiguousarray(small)
+
+    scale = ANALYSIS_MAX_SIDE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def _rms_contrast(values):
+    mean = float(np.mean(values))
+    if mean <= 1e-6:
+        return 0.0
+    return float(np.std(values)) / mean
+
+
+def _veiling_loss(gray, labels, label, stats, reference_contrast):
+    """
+    Потеря локального контраста в кольце вокруг источника блика
+    относительно контраста остального кадра (0 - нет вуали, 1 - контраст пропал).
+    """
+    x, y, w, h, area = stats[label]
+    ring_width = max(MIN_RING_WIDTH, int(np.sqrt(area)))
+
+    # Работаем только в окрестности источника
+    x0, y0 = max(0, x - ring_width), max(0, y - ring_width)
+    x1 = min(gray.shape[1], x + w + ring_width)
+    y1 = min(gray.shape[0], y + h + ring_width)
+    source = (labels[y0:y1, x0:x1] == label).astype(np.uint8)
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * ring_width + 1, 2 * ring_width + 1))
+    ring = cv2.dilate(source, kernel) > 0
+    ring &= cv2.dilate(source, np.ones((3, 3), np.uint8)) == 0
+
+    ring_values = gray[y0:y1, x0:x1][ring]
+    if ring_values.size == 0 or reference_contrast <= 1e-6:
+        return 0.0
+    return float(np.clip(1.0 - _rms_contrast(ring_values) / reference_contrast, 0.0, 1.0))
+
+
+def analyze_glare(image_data):
+    """
+    Ищет блики и засветку на уменьшенной плоскости яркости.
+
+    Пересвеченные области выделяются порогом и разбиваются на компоненты связности.
+    Для каждого крупного источника оценивается вуалирующая засветка - потеря
+    локального контраста в кольце вокруг него. Стоимость не зависит от разрешения кадра.
+
+    Возвращает:
+    - glare: оценка 0-10 (10 - бликов нет, 0 - сильные блики)
+    - sources: количество найденных источников
+    - highlight_fraction: доля пересвеченных пикселей
+    - veiling_glare: средневзвешенная потеря контраста вокруг источников (0-1)
+    """
+    if image_data is None or image_data.size == 0:
+        return {"glare": 10.0, "sources": 0, "highlight_fraction": 0.0, "veiling_glare": 0.0}
+
+    gray = _luminance_plane(image_data)
+    highlights = (gray >= HIGHLIGHT_LEVEL).astype(np.uint8)
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(highlights, connectivity=8)
+
+    # Метка 0 - фон; отбрасываем шумовые точки и берём самые крупные источники
+    sources = [i for i in range(1, n_labels) if stats[i, cv2.CC_STAT_AREA] >= MIN_SOURCE_AREA]
+    sources = sorted(sources, key=lambda i: stats[i, cv2.CC_STAT_AREA], reverse=True)[:MAX_SOURCES]
+    highlight_fraction = float(highlights.mean())
+
+    if not sources:
+        return {"glare": 10.0, "sources": 0, "highlight_fraction": highlight_fraction, "veiling_glare": 0.0}
+
+    # Эталонный контраст - кадр без пересветов и их ближайшей окрестности
+    near_highlights = cv2.dilate(highlights, np.ones((2 * MIN_RING_WIDTH + 1,) * 2, np.uint8)) > 0
+    background = gray[~near_highlights]
+    reference_contrast = _rms_contrast(background) if background.size else 0.0
+
+    areas = np.array([stats[i, cv2.CC_STAT_AREA] for i in sources], dtype=np.float64)
+    losses = np.array([_veiling_loss(gray, labels, i, stats, reference_contrast) for i in sources])
+    veiling_glare = float(np.average(losses, weights=areas))
+
+    area_penalty = min(1.0, highlight_fraction / MAX_HIGHLIGHT_FRACTION)
+    glare_index = np.clip(0.7 * veiling_glare + 0.3 * area_penalty, 0.0, 1.0)
+
+    return {
+        "glare": round(float(10.0 * (1.0 - glare_index)), 3),
+        "sources": len(sources),
+        "highlight_fraction": highlight_fraction,
+        "veiling_glare": veiling_glare,
+    }
+
+
+@version(2)  # 2 - детектор бликов и вуалирующей засветки вместо случайного значения
 def calculate_glare(image_data):
-    return random.uniform(0, 10)
+    return analyze_glare(image_data)["glare"]
@@ -1,67 +1,226 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-import tempfile
 
-def calculate_noise(image_data):
+from image_analyz.charts import new_figure, save_chart
+from image_analyz.image_cache import per_image_cache
+from image_analyz.metrics import version
+
+TILE_SIZE = 32  # Сторона плитки, пиксели исходного кадра
+SELECTION_SCALE = 4  # Во сколько раз уменьшается кадр для поиска однородных плиток
+FLAT_QUANTILE = 0.3  # Однородные плитки - с дисперсией не выше этого квантиля по всем плиткам кадра
+CLIP_LOW, CLIP_HIGH = 10, 245  # Плитки темнее/светлее почти обрезаны, шум в них занижен
+BRIGHTNESS_BINS = 8  # На сколько диапазонов яркости делим плитки для кривой шум/яркость
+TILES_PER_BIN = 32  # Сколько самых однородных плиток берём из каждого диапазона
+NOISE_SCALES = (1, 2)  # Масштабы (1 - исходный, 2 - с усреднением 2x2), на которых ищем шум
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+TILES_PER_WORKER = 64  # Меньше плиток на поток не делим: накладные расходы больше выигрыша
+MAX_SIGMA = 10.0  # σ шума (0-255), при которой оценка достигает 10
+
+CHANNELS = ("blue", "green", "red")  # Порядок каналов BGR в OpenCV
+MAD_TO_SIGMA = 1 / 0.6745  # MAD нормального распределения = 0.6745σ
+
+
+def _select_tiles(image_data):
+    """
+    Однородные плитки для оценки шума: [(y, x, средняя яркость)].
+
+    Дисперсия яркости всех плиток считается по интегральным изображениям
+    уменьшенного кадра (усреднение подавляет шум и оставляет текстуру),
+    так что выбор стоит O(1) на плитку. В каждом диапазоне яркости берутся
+    самые однородные плитки, чтобы кривая шум/яркость покрывала весь кадр.
+    """
+    h, w = image_data.shape[:2]
+    n_ty, n_tx = h // TILE_SIZE, w // TILE_SIZE
+    if n_ty == 0 or n_tx == 0:
+        return []
+
+    cell = TILE_SIZE // SELECTION_SCALE
+    small = cv2.resize(
+        image_data[: n_ty * TILE_SIZE, : n_tx * TILE_SIZE],
+        (n_tx * cell, n_ty * cell),
+        interpolation=cv2.INTER_AREA,
+    )
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    total, squares = cv2.integral2(gray, sdepth=cv2.CV_64F)
+
+    def tile_sums(integral):
+        corners = integral[::cell, ::cell]
+        return corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+
+    area = cell * cell
+    mean = tile_sums(total) / area
+    variance = (tile_sums(squares) / area - mean ** 2).ravel()
+    mean = mean.ravel()
+
+    unclipped = (mean >= CLIP_LOW) & (mean <= CLIP_HIGH)
+    if not unclipped.any():
+        return []
+    flat = unclipped & (variance <= np.quantile(variance[unclipped], FLAT_QUANTILE))
+
+    edges = np.linspace(CLIP_LOW, CLIP_HIGH, BRIGHTNESS_BINS + 1)
+    bin_index = np.clip(np.digitize(mean, edges) - 1, 0, BRIGHTNESS_BINS - 1)
+    selected = []
+    for i in range(BRIGHTNESS_BINS):
+        idx = np.flatnonzero(flat & (bin_index == i))
+        selected.extend(idx[np.argsort(variance[idx])[:TILES_PER_BIN]].tolist())
+
+    return [(int(i // n_tx) * TILE_SIZE, int(i % n_tx) * TILE_SIZE, float(mean[i])) for i in selected]
+
+
+def _tile_sigmas(image_data, tiles):
+    """
+    σ шума для плиток: массив (плитки, масштабы, каналы).
+
+    Высокочастотная составляющая - диагональные коэффициенты вейвлета Хаара
+    (a - b - c + d) / 2: плавные перепады яркости они подавляют, а σ белого шума
+    сохраняют. σ оценивается устойчиво, через медианное абсолютное отклонение.
+    На масштабе 2 тот же расчёт повторяется после усреднения 2x2 (шум, сглаженный
+    демозаикой и шумоподавлением телефона, виден на нём лучше); значение приводится
+    к исходному масштабу.
+    """
+    stack = np.stack([image_data[y:y + TILE_SIZE, x:x + TILE_SIZE] for y, x, _ in tiles]).astype(np.float32)
+    sigmas = []
+    for scale in NOISE_SCALES:
+        if scale > 1:
+            n, size = stack.shape[0], TILE_SIZE // scale
+            data = stack.reshape(n, size, scale, size, scale, -1).mean(axis=(2, 4))
+        else:
+            data = stack
+        hh = (data[:, 0::2, 0::2] - data[:, 0::2, 1::2] - data[:, 1::2, 0::2] + data[:, 1::2, 1::2]) / 2
+        hh = hh.reshape(hh.shape[0], -1, hh.shape[-1])
+        mad = np.median(np.abs(hh - np.median(hh, axis=1, keepdims=True)), axis=1)
+        # Усреднение scale x scale уменьшает σ белого шума в scale раз
+        sigmas.append(mad * MAD_TO_SIGMA * scale)
+    return np.stack(sigmas, axis=1)
+
+
+@per_image_cache
+def analyze_noise(image_data):
+    """
+    Оценивает шум сенсора по однородным участкам кадра.
+
+    Кадр делится на плитки, по интегральным изображениям отбираются однородные
+    (без текстуры) плитки в разных диапазонах яркости, и только они читаются
+    в полном разрешении. В каждой σ шума оценивается по каналам (см. _tile_sigmas);
+    плитки обрабатываются параллельно в потоках.
+
+    Возвращает:
+    - noise: оценка 0-10 (0 - нет шума, 10 - сильный шум)
+    - sigma: σ шума (0-255) - медиана по плиткам среднего по каналам (наибольшая по масштабам)
+    - tiles: [(y, x, яркость, σ по каналам B, G, R)] по плиткам
+    - brightness_bins: центры диапазонов яркости
+    - curve: {канал: [медиана σ в каждом диапазоне яркости или None]} - кривая шум/яркость
+    """
+    empty = {
+        "noise": 0.0,
+        "sigma": 0.0,
+        "tiles": [],
+        "brightness_bins": [],
+        "curve": {channel: [] for channel in CHANNELS},
+    }
+    if image_data is None or image_data.size == 0:
+        return empty
+    if image_data.ndim == 2:
+        image_data = cv2.cvtColor(image_data, cv2.COLOR_GRAY2BGR)
+
+    tiles = _select_tiles(image_data)
+    if not tiles:
+        return empty
+
+    chunks = [tiles[i:i + TILES_PER_WORKER] for i in range(0, len(tiles), TILES_PER_WORKER)]
+    if len(chunks) == 1:
+        sigmas = _tile_sigmas(image_data, tiles)
+    else:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            sigmas = np.concatenate(list(pool.map(lambda chunk: _tile_sigmas(image_data, chunk), chunks)))
+
+    brightness = np.array([mean for _, _, mean in tiles])
+    edges = np.linspace(CLIP_LOW, CLIP_HIGH, BRIGHTNESS_BINS + 1)
+    bin_index = np.clip(np.digitize(brightness, edges) - 1, 0, BRIGHTNESS_BINS - 1)
+    # Медианы берутся отдельно по каждому масштабу и только потом - максимум по масштабам:
+    # максимум шумных оценок отдельных плиток был бы завышен
+    curve = {channel: [] for channel in CHANNELS}
+    for i in range(BRIGHTNESS_BINS):
+        in_bin = sigmas[bin_index == i]
+        for c, channel in enumerate(CHANNELS):
+            curve[channel].append(float(np.median(in_bin[:, :, c], axis=0).max()) if len(in_bin) else None)
+
+    sigma = float(np.median(sigmas.mean(axis=2), axis=0).max())
+    return {
+        "noise": float(np.clip(sigma / MAX_SIGMA * 10, 0, 10)),
+        "sigma": sigma,
+        "tiles": [(y, x, mean, *map(float, s.max(axis=0))) for (y, x, mean), s in zip(tiles, sigmas)],
+        "brightness_bins": (0.5 * (edges[:-1] + edges[1:])).tolist(),
+        "curve": curve,
+    }
+
+
+@version(2)  # 2 - σ на однородных плитках вместо σ разности с размытием по всему кадру
+def calculate_noise(image_data, with_chart=False):
     """
     Анализирует уровень шума на изображении
-    
+
     Возвращает:
     - noise_score: оценка шума (0-10, где 0 - нет шума, 10 - сильный шум)
-    - aberration_chart: путь к файлу с визуализацией шума
+    - aberration_chart: изображение с визуализацией шума в байтах (None, если with_chart=False)
     """
     if image_data is None or image_data.size == 0:
         return {
             'noise': 0.0,
             'aberration_chart': None
         }
-    
-    # Конвертируем в grayscale для анализа яркости
-    gray = cv2.cvtColor(image_data, cv2.COLOR_BGR2GRAY)
-    
-    # Применяем фильтр для выделения шума (разница между оригиналом и размытой версией)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    noise = cv2.absdiff(gray, blurred)
-    
-    # Вычисляем стандартное отклонение как меру шума
-    noise_std = np.std(noise)
-    
-    # Нормализуем оценку шума (0-10)
-    # Эмпирически подобранные значения для нормализации
-    max_std = 25  # Значение, соответствующее сильному шуму
-    noise_score = min(10, (noise_std / max_std) * 10)
-    
+
+    result = analyze_noise(image_data)
+
+    # В общем анализе нужна только оценка, визуализацию бот рисует отдельно
+    if not with_chart:
+        return {
+            'noise': result["noise"],
+            'aberration_chart': None
+        }
+
     # Создаем визуализацию
-    fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(15, 5))
-    
-    # 1. Оригинальное изображение
-    ax1.imshow(cv2.cvtColor(image_data, cv2.COLOR_BGR2RGB))
-    ax1.set_title('Оригинал')
+    from matplotlib.patches import Rectangle
+
+    fig = new_figure((12, 5))
+    ax1, ax2 = fig.subplots(1, 2)
+
+    # 1. Уменьшенная копия кадра с отмеченными плитками
+    h, w = image_data.shape[:2]
+    scale = min(1.0, 1024 / max(h, w))
+    preview = cv2.resize(image_data, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ax1.imshow(cv2.cvtColor(preview, cv2.COLOR_BGR2RGB) if preview.ndim == 3 else preview, cmap='gray')
+    for y, x, *_ in result["tiles"]:
+        ax1.add_patch(Rectangle(
+            (x * scale, y * scale), TILE_SIZE * scale, TILE_SIZE * scale,
+            fill=False, edgecolor='yellow', linewidth=0.5,
+        ))
+    ax1.set_title(f'Однородные участки ({len(result["tiles"])})')
     ax1.axis('off')
-    
-    # 2. Визуализация шума
-    ax2.imshow(noise, cmap='gray', vmin=0, vmax=255)
-    ax2.set_title(f'Выделенный шум\n(σ={noise_std:.1f})')
-    ax2.axis('off')
-    
-    # 3. Гистограмма шума
-    ax3.hist(noise.ravel(), bins=50, color='blue', alpha=0.7)
-    ax3.set_title('Распределение шума')
-    ax3.set_xlabel('Значение шума')
-    ax3.set_ylabel('Частота')
-    ax3.grid(True)
-    
-    plt.tight_layout()
-    
-    # Сохраняем визуализацию во временный файл
-    noise_vis_path = None
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-        plt.savefig(tmp.name, bbox_inches='tight', dpi=100)
-        plt.close()
-        noise_vis_path = tmp.name
-    
+
+    # 2. Кривая шум/яркость по каналам
+    centers = result["brightness_bins"]
+    for channel, color, label in zip(CHANNELS, ("blue", "green", "red"), ("B", "G", "R")):
+        points = [(c, v) for c, v in zip(centers, result["curve"][channel]) if v is not None]
+        if points:
+            ax2.plot(*zip(*points), marker="o", color=color, label=label)
+    ax2.set_title(f'Шум в зависимости от яркости\n(σ={result["sigma"]:.2f})')
+    ax2.set_xlabel('Яркость участка (0-255)')
+    ax2.set_ylabel('σ шума')
+    ax2.set_xlim(0, 255)
+    ax2.grid(True)
+    if result["tiles"]:
+        ax2.legend()
+
+    fig.tight_layout()
+
+    # Кодируем визуализацию в память
+    noise_chart = save_chart(fig, dpi=100)
+
     return {
-        'noise': float(noise_score),
-        'aberration_chart': noise_vis_path
-    }
\ No newline at end of file
+        'noise': result["noise"],
+        'aberration_chart': noise_chart
+    }
@@ -1,5 +1,188 @@
-import random
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+import cv2
+import numpy as np
 
+from image_analyz.image_cache import per_image_cache
+from image_analyz.metrics import version
+
+# Зоны кадра, в которых оценивается резкость: (доля от ширины, доля от высоты) центра зоны
+ZONES = {
+    "center": (0.5, 0.5),
+    "top_left": (0.0, 0.0),
+    "top_right": (1.0, 0.0),
+    "bottom_left": (0.0, 1.0),
+    "bottom_right": (1.0, 1.0),
+}
+# Вклад зон в итоговую оценку (центр важнее углов)
+ZONE_WEIGHTS = {
+    "center": 0.4,
+    "top_left": 0.15,
+    "top_right": 0.15,
+    "bottom_left": 0.15,
+    "bottom_right": 0.15,
+}
+ZONE_FRACTION = 0.3  # Зона занимает 30% ширины и высоты кадра
+TILE_SIZE = 256  # Сторона плитки в пикселях исходного изображения
+TILES_PER_ZONE = 3  # Сетка плиток 3x3 в каждой зоне, т.е. стоимость не зависит от размера кадра
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+# Параметры slanted-edge (ISO 12233, упрощённо)
+ESF_OVERSAMPLING = 4  # Бинов на пиксель при построении ESF
+ESF_HALF_WIDTH = 16  # Сколько пикселей по обе стороны от края берём в ESF
+MIN_EDGE_COHERENCE = 0.6  # Минимальная "прямолинейность" края в плитке
+MIN_EDGE_CONTRAST = 20.0  # Минимальная разница яркостей по обе стороны края
+
+# Нормировка в шкалу 0-10
+GOOD_LAPLACIAN_VAR = 1000.0  # Дисперсия лапласиана, считающаяся "полностью резко"
+GOOD_MTF50 = 0.3  # MTF50 в циклах на пиксель, считающийся "полностью резко"
+
+
+def _zone_tiles(shape, zone):
+    """Координаты (y, x, size) плиток зоны."""
+    h, w = shape[:2]
+    fx, fy = ZONES[zone]
+    zone_w = max(1, int(w * ZONE_FRACTION))
+    zone_h = max(1, int(h * ZONE_FRACTION))
+    x0 = int(np.clip(fx * w - zone_w / 2, 0, w - zone_w))
+    y0 = int(np.clip(fy * h - zone_h / 2, 0, h - zone_h))
+
+    size = min(TILE_SIZE, zone_w, zone_h)
+    xs = np.linspace(x0, x0 + zone_w - size, TILES_PER_ZONE).astype(int)
+    ys = np.linspace(y0, y0 + zone_h - size, TILES_PER_ZONE).astype(int)
+    return [(int(y), int(x), size) for y in ys for x in xs]
+
+
+def _edge_normal(gray):
+    """
+    Направление нормали к доминирующему краю плитки по структурному тензору.
+    Возвращает (nx, ny, coherence), coherence близка к 1 для одного прямого края.
+    """
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    jxx = float(np.sum(gx * gx))
+    jyy = float(np.sum(gy * gy))
+    jxy = float(np.sum(gx * gy))
+    trace = jxx + jyy
+    if trace <= 1e-6:
+        return 0.0, 0.0, 0.0
+
+    coherence = np.sqrt((jxx - jyy) ** 2 + 4 * jxy ** 2) / trace
+    angle = 0.5 * np.arctan2(2 * jxy, jxx - jyy)
+    return float(np.cos(angle)), float(np.sin(angle)), float(coherence)
+
+
+def _slanted_edge_mtf50(gray):
+    """
+    MTF50 (циклы на пиксель) по наклонному краю в плитке или None,
+    если в плитке нет подходящего края.
+    """
+    nx, ny, coherence = _edge_normal(gray)
+    if coherence < MIN_EDGE_COHERENCE:
+        return None
+
+    # Положение края: центр масс модуля градиента
+    magnitude = cv2.magnitude(
+        cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3),
+        cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3),
+    )
+    total = float(magnitude.sum())
+    if total <= 1e-6:
+        return None
+    ys, xs = np.indices(gray.shape, dtype=np.float32)
+    cx = float((magnitude * xs).sum()) / total
+    cy = float((magnitude * ys).sum()) / total
+
+    # Проекция пикселей на нормаль к краю -> ESF с передискретизацией
+    distance = (xs - cx) * nx + (ys - cy) * ny
+    mask = np.abs(distance) < ESF_HALF_WIDTH
+    n_bins = 2 * ESF_HALF_WIDTH * ESF_OVERSAMPLING
+    bins = ((distance[mask] + ESF_HALF_WIDTH) * ESF_OVERSAMPLING).astype(int)
+    counts = np.bincount(bins, minlength=n_bins)[:n_bins]
+    sums = np.bincount(bins, weights=gray[mask], minlength=n_bins)[:n_bins]
+    filled = counts > 0
+    if filled.sum() < n_bins // 2:
+        return None
+    positions = np.arange(n_bins)
+    esf = np.interp(positions, positions[filled], sums[filled] / counts[filled])
+
+    edge_contrast = abs(esf[-ESF_OVERSAMPLING:].mean() - esf[:ESF_OVERSAMPLING].mean())
+    if edge_contrast < MIN_EDGE_CONTRAST:
+        return None
+
+    # LSF -> MTF
+    lsf = np.diff(esf) * np.hamming(n_bins - 1)
+    mtf = np.abs(np.fft.rfft(lsf))
+    if mtf[0] <= 1e-6:
+        return None
+    mtf /= mtf[0]
+    freqs = np.fft.rfftfreq(lsf.size, d=1.0 / ESF_OVERSAMPLING)
+
+    below = np.nonzero(mtf < 0.5)[0]
+    if below.size == 0:
+        return float(freqs[-1])
+    i = below[0]
+    # Линейная интерполяция между соседними отсчётами
+    f0, f1, m0, m1 = freqs[i - 1], freqs[i], mtf[i - 1], mtf[i]
+    return float(f0 + (m0 - 0.5) * (f1 - f0) / (m0 - m1))
+
+
+def _analyze_tile(image, tile):
+    """Дисперсия лапласиана и MTF50 для одной плитки."""
+    y, x, size = tile
+    roi = image[y:y + size, x:x + size]
+    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if roi.ndim == 3 else roi
+    gray = gray.astype(np.float32)
+
+    _, std = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_32F, ksize=3))
+    return float(std[0, 0] ** 2), _slanted_edge_mtf50(gray)
+
+
+def _zone_score(laplacian_var, mtf50):
+    """Оценка зоны 0-10 по дисперсии лапласиана и (если нашёлся край) по MTF50."""
+    terms = [np.clip(np.log10(1 + laplacian_var) / np.log10(1 + GOOD_LAPLACIAN_VAR), 0, 1)]
+    if mtf50 is not None:
+        terms.append(np.clip(mtf50 / GOOD_MTF50, 0, 1))
+    return float(10 * np.mean(terms))
+
+
+@per_image_cache
+def analyze_sharpness(image_data):
+    """
+    Оценивает резкость по зонам кадра (центр и четыре угла).
+
+    В каждой зоне берётся сетка плиток фиксированного размера, для каждой
+    считается дисперсия лапласиана и MTF50 по наклонному краю (если он есть).
+    Плитки обрабатываются параллельно в потоках (OpenCV отпускает GIL).
+
+    Возвращает:
+    - sharpness: итоговая оценка 0-10 (10 - максимально резко)
+    - zones: {зона: {"score", "laplacian_var", "mtf50"}}
+    """
+    if image_data is None or image_data.size == 0:
+        return {"sharpness": 0.0, "zones": {}}
+
+    tiles = [(zone, tile) for zone in ZONES for tile in _zone_tiles(image_data.shape, zone)]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        results = list(pool.map(lambda item: _analyze_tile(image_data, item[1]), tiles))
+
+    zones = {}
+    for zone in ZONES:
+        zone_results = [res for (name, _), res in zip(tiles, results) if name == zone]
+        laplacian_var = float(np.median([lap for lap, _ in zone_results]))
+        mtf_values = [mtf for _, mtf in zone_results if mtf is not None]
+        mtf50 = float(np.median(mtf_values)) if mtf_values else None
+        zones[zone] = {
+            "score": _zone_score(laplacian_var, mtf50),
+            "laplacian_var": laplacian_var,
+            "mtf50": mtf50,
+        }
+
+    score = sum(ZONE_WEIGHTS[zone] * zones[zone]["score"] for zone in ZONES)
+    return {"sharpness": round(score, 3), "zones": zones}
+
+
+@version(2)  # 2 - плитки, лапласиан и MTF50 вместо случайного значения
 def calculate_sharpness(image_data):
-    return random.uniform(0, 10)
+    return analyze_sharpness(image_data)["sharpness"]
@@ -1,6 +1,5 @@
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
 
 
 def calculate_vignetting(image: np.ndarray, show_plot: bool = False) -> dict:
@@ -103,6 +102,8 @@ def compute_gradient_asymmetry(grad_radial: np.ndarray, bins: int = 100, show_pl
 
     # Раньше использовал для отладки
     if show_plot:
+        import matplotlib.pyplot as plt
+
         centers = 0.5 * (bin_edges[:-1] + bin_edges[1:])
         plt.figure(figsize=(8, 4))
         plt.title("Гистограмма логарифмированных радиальных градиентов")
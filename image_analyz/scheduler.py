@@ -0,0 +1,94 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+from monitoring.metrics import METRIC_SECONDS
+
+# Расчёт метрик одного изображения.
+# Метрики почти всё время проводят в OpenCV и NumPy, которые отпускают GIL, поэтому
+# независимые метрики считаются одновременно в общем пуле из METRIC_THREADS потоков
+# (METRIC_THREADS=1 - по очереди в вызывающем потоке).
+# Метрика может объявить зависимости (@depends_on из image_analyz.metrics): она
+# запускается только после того, как посчитаны все метрики, от которых зависит.
+
+METRIC_THREADS = max(1, int(os.getenv("METRIC_THREADS", min(8, os.cpu_count() or 1))))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Общий пул потоков для метрик (создаётся при первом параллельном анализе)."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=METRIC_THREADS, thread_name_prefix="metric")
+        return _executor
+
+
+def dependencies(metric_functions):
+    """{метрика: множество метрик, от которых она зависит}; ValueError для неизвестных зависимостей."""
+    result = {}
+    for name, func in metric_functions.items():
+        required = set(getattr(func, "depends_on", ()))
+        unknown = required - set(metric_functions)
+        if unknown:
+            raise ValueError(f"Метрика {name} зависит от неизвестных метрик: {', '.join(sorted(unknown))}")
+        result[name] = required
+    return result
+
+
+def execution_order(deps):
+    """Порядок расчёта, в котором каждая метрика идёт после своих зависимостей; ValueError для циклов."""
+    order, done = [], set()
+    pending = list(deps)
+    while pending:
+        ready = [name for name in pending if deps[name] <= done]
+        if not ready:
+            raise ValueError(f"Циклическая зависимость между метриками: {', '.join(pending)}")
+        order.extend(ready)
+        done.update(ready)
+        pending = [name for name in pending if name not in done]
+    return order
+
+
+def _run_metric(name, func, image_data, track=None):
+    with track(name) if track else nullcontext(), METRIC_SECONDS.time(metric=name):
+        return func(image_data)
+
+
+def run_metrics(image_data, metric_functions, parallel=True, track=None):
+    """
+    Считает метрики для изображения; возвращает {метрика: результат} в порядке metric_functions.
+    parallel=False - по очереди в текущем потоке (нужно для замеров памяти и профилирования);
+    track(name) - контекстный менеджер вокруг расчёта каждой метрики.
+    """
+    deps = dependencies(metric_functions)
+    order = execution_order(deps)
+
+    if not parallel or METRIC_THREADS == 1:
+        results = {name: _run_metric(name, metric_functions[name], image_data, track) for name in order}
+        return {name: results[name] for name in metric_functions}
+
+    executor = _get_executor()
+    results = {}
+    running = {}
+    pending = order
+    try:
+        while pending or running:
+            ready = [name for name in pending if deps[name] <= results.keys()]
+            pending = [name for name in pending if name not in ready]
+            for name in ready:
+                future = executor.submit(_run_metric, name, metric_functions[name], image_data, track)
+                running[future] = name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results[running.pop(future)] = future.result()
+    finally:
+        # При ошибке в одной метрике остальные, ещё не начавшиеся, не запускаем
+        for future in running:
+            future.cancel()
+
+    return {name: results[name] for name in metric_functions}
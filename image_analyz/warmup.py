@@ -0,0 +1,36 @@
+import logging
+import time
+
+from .charts import new_figure
+from .metrics import get_metrics
+from .metrics.color import load_reference_patches
+
+# Прогрев перед стартом бота: всё, что иначе выполнилось бы на первом фото.
+# Каждый шаг замеряется, чтобы было видно, из чего складывается время до готовности.
+
+logger = logging.getLogger(__name__)
+
+
+def _prime_matplotlib():
+    """Импорт matplotlib, загрузка кэша шрифтов и отрисовка кириллического текста в Agg."""
+    fig = new_figure((1, 1))
+    fig.text(0.5, 0.5, "Качество 0.0", fontsize=10, fontweight="bold")
+    fig.canvas.draw()
+
+
+WARMUP_STEPS = (
+    ("metrics", get_metrics),  # Импорт модулей метрик (cv2, numpy) и сборка реестра
+    ("reference", load_reference_patches),  # Эталон ColorChecker для баланса белого метода 5
+    ("matplotlib", _prime_matplotlib),
+)
+
+
+def warm_up():
+    """Выполняет шаги прогрева; возвращает [(шаг, секунды)]."""
+    timings = []
+    for name, step in WARMUP_STEPS:
+        started = time.perf_counter()
+        step()
+        timings.append((name, time.perf_counter() - started))
+        logger.info("Прогрев %s: %.3f с", name, timings[-1][1])
+    return timings
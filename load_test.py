@@ -0,0 +1,399 @@
+# Нагрузочный тест обработчиков бота на моках из test.py.
+#
+# N пользователей одновременно выбирают метод, модель телефона и отправляют фото
+# (JPEG реального размера, по умолчанию 12 Мп) во временную SQLite-БД. Скачивание
+# файла подменено копированием заранее подготовленного JPEG, всё остальное -
+# декодирование, анализ, диаграммы, запись в БД - работает как в боте.
+#
+# С --fake-api вместо моков сообщений бот работает с локальным фейковым сервером
+# Bot API (FakeBotAPI): запросы идут через настоящую сессию бота и очередь исходящих
+# сообщений (bot.outbound), файл фото скачивается с сервера, а сервер имитирует
+# flood control Telegram - отвечает RetryAfter, если чат или бот превышают лимит.
+# С --local-api фейковый сервер работает как локальный telegram-bot-api: getFile
+# возвращает путь к файлу на диске, и бот читает фото прямо оттуда.
+#
+# Отчёт:
+# - пропускная способность (фото в секунду до завершения всех фоновых задач);
+# - p50/p95/p99/max времени обработчиков и полной обработки фото (до последнего ответа бота;
+#   с --fake-api/--local-api - до последнего запроса в чат, принятого сервером, то есть
+#   с учётом очереди исходящих сообщений и повторов после RetryAfter);
+# - задержка цикла событий: насколько позже срабатывает asyncio.sleep(LAG_INTERVAL);
+# - с --fake-api: запросы к серверу, ответы RetryAfter и сообщения об ошибках.
+#
+# Запуск из консоли (токен может быть любым, к Telegram тест не обращается):
+#     TELEGRAM_BOT_TOKEN=123456:ABCDEF python load_test.py --users 20 --photos 3
+#     TELEGRAM_BOT_TOKEN=123456:ABCDEF python load_test.py --users 50 --size 1920x1080 --method method4
+#     TELEGRAM_BOT_TOKEN=123456:ABCDEF python load_test.py --users 20 --fake-api --flood-chat 2
+#     TELEGRAM_BOT_TOKEN=123456:ABCDEF python load_test.py --users 20 --local-api --size 8000x6000
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+from unittest.mock import AsyncMock, patch
+
+import cv2
+import numpy as np
+
+# БД и сервер Bot API задаются до импорта бота: data.db и бот создаются при импорте
+_db_dir = tempfile.mkdtemp(prefix="load_test_")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_db_dir, 'ratings.db')}"
+_fake_api_port = None
+if "--fake-api" in sys.argv or "--local-api" in sys.argv:
+    with socket.socket() as _sock:
+        _sock.bind(("127.0.0.1", 0))
+        _fake_api_port = _sock.getsockname()[1]
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{_fake_api_port}"
+    if "--local-api" in sys.argv:
+        os.environ["TELEGRAM_API_LOCAL"] = "1"
+
+from aiogram.types import CallbackQuery, Chat, Document, Message, User  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from test import MockCallbackQuery, MockChat, MockDocument, MockMessage, MockUser, safe_create_tables  # noqa: E402
+from bot.telegram_bot import (  # noqa: E402
+    ANALYSIS_METHODS,
+    bot,
+    initialize_bot_dependencies,
+    router,
+    wait_background_tasks,
+)
+from data.repository import RatingRepository  # noqa: E402
+
+LAG_INTERVAL = 0.01  # Период замера задержки цикла событий, с
+PERCENTILES = (50, 95, 99)
+FAKE_FILE_PATH = "photos/load_test.jpg"
+
+
+def create_photo(width, height, seed=0):
+    """Синтетический «снимок»: плавный фон, объекты с резкими краями и шум сенсора."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([
+        60 + 150 * y / height,
+        90 + 100 * x / width,
+        200 - 120 * y / height,
+    ], axis=-1)
+    for _ in range(40):
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(min(width, height) // 40, min(width, height) // 8))
+        color = tuple(float(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            cv2.circle(img, (cx, cy), size, color, -1, lineType=cv2.LINE_AA)
+        else:
+            cv2.rectangle(img, (cx, cy), (cx + size, cy + size), color, -1)
+    img += rng.normal(0, 4, img.shape).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def find_handler(handlers, name):
+    for handler in handlers:
+        if getattr(handler.callback, "__name__", None) == name:
+            return handler.callback
+    raise LookupError(f"Хендлер {name} не найден")
+
+
+async def measure_loop_lag(samples, stop):
+    """Пока не установлен stop, записывает, на сколько позже срабатывает sleep(LAG_INTERVAL)."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(loop.time() - start - LAG_INTERVAL)
+
+
+class FakeBotAPI:
+    """
+    Минимальный сервер Bot API: отвечает на методы бота, отдаёт файл фото и, как Telegram,
+    отвечает 429 RetryAfter, если за последнюю секунду в чат ушло больше chat_limit сообщений
+    или всего больше global_limit. local=True - как локальный сервер: getFile отдаёт путь на диске.
+    """
+
+    def __init__(self, port, photo_path, chat_limit, global_limit, local=False):
+        self.port = port
+        self.photo_path = photo_path
+        self.local = local
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.requests = Counter()  # {метод: запросов}
+        self.retry_after = 0
+        self.error_messages = 0
+        self.sent = defaultdict(deque)  # {чат: время отправленных сообщений за последнюю секунду}
+        self.delivered = defaultdict(list)  # {чат: время (perf_counter) каждого принятого запроса}
+        self.message_id = 0
+        self.runner = None
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def is_flooded(self, chat_id, messages):
+        now = time.monotonic()
+        for times in (self.sent[chat_id], self.sent[None]):
+            while times and times[0] <= now - 1:
+                times.popleft()
+        if len(self.sent[chat_id]) + messages > self.chat_limit or len(self.sent[None]) + messages > self.global_limit:
+            return True
+        self.sent[chat_id].extend([now] * messages)
+        self.sent[None].extend([now] * messages)
+        return False
+
+    def new_message(self, chat_id):
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+
+    async def handle_method(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.requests[method] += 1
+
+        if method == "getFile":
+            return web.json_response({"ok": True, "result": {
+                "file_id": data["file_id"], "file_unique_id": data["file_id"],
+                "file_path": self.photo_path if self.local else FAKE_FILE_PATH,
+            }})
+        if "chat_id" not in data:
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(data["chat_id"])
+        media = json.loads(data["media"]) if method == "sendMediaGroup" else None
+        if self.is_flooded(chat_id, len(media) if media else 1):
+            self.retry_after += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+
+        self.delivered[chat_id].append(time.perf_counter())
+        if "Ошибка" in data.get("text", ""):
+            self.error_messages += 1
+        if media:
+            return web.json_response({"ok": True, "result": [self.new_message(chat_id) for _ in media]})
+        return web.json_response({"ok": True, "result": self.new_message(chat_id)})
+
+    async def handle_file(self, request):
+        return web.FileResponse(self.photo_path)
+
+
+class LoadTester:
+    def __init__(self, num_users, photos_per_user, photo_path, methods, fake_api=None):
+        self.users = [MockUser(i + 1) for i in range(num_users)]
+        self.photos_per_user = photos_per_user
+        self.photo_path = photo_path
+        self.methods = methods
+        self.fake_api = fake_api
+        self.repo = RatingRepository()
+        self.timings = defaultdict(list)  # {этап: [секунды]}
+        self.replies = []  # [(начало обработки фото, сообщение)] для полной обработки
+        self.errors = 0
+        self.update_id = 0
+
+    async def setup(self):
+        await safe_create_tables()
+        await initialize_bot_dependencies(self.repo)
+        await self.repo.initialize_default_models()
+        await self.repo.load_cache()
+        self.phone_model = await self.repo.get_phone_model("iPhone 14")
+        self.select_method = find_handler(router.callback_query.handlers, "callback_method_selected")
+        self.select_phone = find_handler(router.callback_query.handlers, "callback_phone_selected")
+        self.handle_photo = find_handler(router.message.handlers, "handle_photo")
+
+    def message(self, user, document=None):
+        """Сообщение пользователя: мок из test.py или, с фейковым сервером, настоящее Message."""
+        if self.fake_api is None:
+            message = MockMessage(user, MockChat(user.id), document=document)
+            # Время каждого ответа бота: по последнему считается полная обработка фото
+            message.sent = []
+            message.reply.side_effect = lambda *args, sent=message.sent, **kwargs: sent.append(time.perf_counter())
+            return message
+        self.update_id += 1
+        return Message(
+            message_id=self.update_id,
+            date=datetime.now(),
+            chat=Chat(id=user.id, type="private"),
+            from_user=User(id=user.id, is_bot=False, first_name=user.first_name, username=user.username),
+            document=document and Document(
+                file_id=document.file_id, file_unique_id=document.file_id, file_name=document.file_name,
+                mime_type=document.mime_type, file_size=document.file_size,
+            ),
+        ).as_(bot)
+
+    def callback(self, user, data):
+        if self.fake_api is None:
+            return MockCallbackQuery(user, data, self.message(user))
+        self.update_id += 1
+        return CallbackQuery(
+            id=str(self.update_id),
+            from_user=User(id=user.id, is_bot=False, first_name=user.first_name, username=user.username),
+            chat_instance="load_test",
+            data=data,
+            message=self.message(user),
+        ).as_(bot)
+
+    async def timed(self, stage, handler, *args):
+        start = time.perf_counter()
+        try:
+            await handler(*args)
+        except Exception as e:
+            self.errors += 1
+            print(f"❌ {stage}: {e!r}")
+        self.timings[stage].append(time.perf_counter() - start)
+
+    async def run_user(self, user):
+        method_id = random.choice(self.methods)
+        await self.timed("callback_method_selected", self.select_method, self.callback(user, f"method_{method_id}"))
+        await self.timed(
+            "callback_phone_selected", self.select_phone, self.callback(user, f"phone_{self.phone_model.id}")
+        )
+        for i in range(self.photos_per_user):
+            document = MockDocument(f"file_{user.id}_{i}", f"load_{user.id}_{i}.jpg")
+            document.file_size = os.path.getsize(self.photo_path)
+            message = self.message(user, document)
+            self.replies.append((time.perf_counter(), message))
+            await self.timed("handle_photo", self.handle_photo, message)
+
+    async def download_file(self, file_path, destination):
+        await asyncio.to_thread(shutil.copyfile, self.photo_path, destination)
+
+    async def run(self):
+        await self.setup()
+
+        class FakeFile:
+            file_path = FAKE_FILE_PATH
+
+        lag, stop = [], asyncio.Event()
+        lag_task = asyncio.create_task(measure_loop_lag(lag, stop))
+        if self.fake_api is None:
+            # Скачивание - копирование подготовленного файла
+            patches = [
+                patch("bot.telegram_bot.bot.get_file", AsyncMock(return_value=FakeFile())),
+                patch("bot.telegram_bot.bot.download_file", self.download_file),
+            ]
+        else:
+            patches = []
+            await self.fake_api.start()
+        for p in patches:
+            p.start()
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*(self.run_user(user) for user in self.users))
+            # Диаграммы и запись в БД отправляются в фоне после ответа с оценками
+            await wait_background_tasks()
+            elapsed = time.perf_counter() - start
+        finally:
+            for p in patches:
+                p.stop()
+            if self.fake_api is not None:
+                await self.fake_api.stop()
+        stop.set()
+        await lag_task
+
+        if self.fake_api is None:
+            self.timings["photo_total"] = [
+                max(message.sent) - begin for begin, message in self.replies if message.sent
+            ]
+        else:
+            self.timings["photo_total"] = self.fake_api_photo_totals()
+        self.timings["loop_lag"] = lag
+        return elapsed
+
+
+    def fake_api_photo_totals(self):
+        """
+        Полная обработка фото по запросам, принятым фейковым сервером: от отправки фото до
+        последнего сообщения в чат перед следующим фото пользователя (для последнего фото - до
+        последнего сообщения вообще). Диаграммы предыдущего фото, пришедшие уже после следующего,
+        попадают в его окно, поэтому при --photos > 1 оценка приблизительная.
+        """
+        begins = defaultdict(list)
+        for begin, message in self.replies:
+            begins[message.chat.id].append(begin)
+        totals = []
+        for chat_id, chat_begins in begins.items():
+            delivered = self.fake_api.delivered[chat_id]
+            for begin, end in zip(chat_begins, chat_begins[1:] + [float("inf")]):
+                window = [sent for sent in delivered if begin <= sent < end]
+                if window:
+                    totals.append(max(window) - begin)
+        return totals
+
+
+def print_report(tester, elapsed):
+    photos = len(tester.replies)
+    print(
+        f"\nПользователей: {len(tester.users)}, фото: {photos}, ошибок: {tester.errors}, "
+        f"время: {elapsed:.2f} с, пропускная способность: {photos / elapsed:.2f} фото/с"
+    )
+    if tester.fake_api is not None:
+        api = tester.fake_api
+        print(
+            f"Запросов к Bot API: {sum(api.requests.values())} ({dict(api.requests)}), "
+            f"ответов RetryAfter: {api.retry_after}, сообщений об ошибке: {api.error_messages}"
+        )
+    header = f"{'этап':<26}{'n':>6}" + "".join(f"{'p' + str(p):>10}" for p in PERCENTILES) + f"{'max':>10}"
+    print(header)
+    for stage, values in tester.timings.items():
+        if not values:
+            continue
+        ms = np.array(values) * 1000
+        row = "".join(f"{np.percentile(ms, p):>10.1f}" for p in PERCENTILES)
+        print(f"{stage:<26}{len(ms):>6}{row}{ms.max():>10.1f}")
+    print("(время в миллисекундах)")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument("--users", type=int, default=20, help="Сколько пользователей работают одновременно")
+    parser.add_argument("--photos", type=int, default=1, help="Сколько фото отправляет каждый пользователь")
+    parser.add_argument("--size", default="4000x3000", help="Размер фото ШИРИНАxВЫСОТА")
+    parser.add_argument("--method", action="append", choices=list(ANALYSIS_METHODS),
+                        help="Метод анализа (можно несколько раз; по умолчанию - случайный из всех)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fake-api", action="store_true", help="Работать с локальным фейковым сервером Bot API")
+    parser.add_argument("--local-api", action="store_true",
+                        help="Фейковый сервер в режиме локального Bot API (бот читает фото с диска)")
+    parser.add_argument("--flood-chat", type=int, default=4, help="Лимит фейкового сервера: сообщений в секунду в чат")
+    parser.add_argument("--flood-global", type=int, default=30, help="Лимит фейкового сервера: сообщений в секунду всего")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    width, height = map(int, args.size.lower().split("x"))
+    photo_path = os.path.join(_db_dir, "photo.jpg")
+    cv2.imwrite(photo_path, create_photo(width, height, args.seed), [cv2.IMWRITE_JPEG_QUALITY, 92])
+
+    fake_api = None
+    if args.fake_api or args.local_api:
+        fake_api = FakeBotAPI(_fake_api_port, photo_path, args.flood_chat, args.flood_global, args.local_api)
+    tester = LoadTester(args.users, args.photos, photo_path, args.method or list(ANALYSIS_METHODS), fake_api)
+
+    async def run():
+        try:
+            return await tester.run()
+        finally:
+            await bot.session.close()
+
+    try:
+        elapsed = asyncio.run(run())
+    finally:
+        shutil.rmtree(_db_dir, ignore_errors=True)
+    print_report(tester, elapsed)
+    return 1 if tester.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,20 +1,57 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # Замер времени импорта модулей бота
+
 import asyncio
+import logging
+import os
 from aiogram import Dispatcher
-from bot.telegram_bot import bot, router, set_commands, initialize_bot_dependencies
+from bot.telegram_bot import bot, router, set_commands, initialize_bot_dependencies, wait_background_tasks
 from data.repository import RatingRepository
 from data.models import Base
 from data.db import engine
+from data.schema import upgrade_schema
+from image_analyz.warmup import warm_up
+from monitoring.server import start_metrics_server
+from sqlalchemy import text
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+logger = logging.getLogger(__name__)
 
 async def safe_create_tables():
     """Создаёт таблицы, если их ещё нет."""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await upgrade_schema()
 
-async def main():
+async def prepare_database():
+    """Таблицы, дефолтные модели и первое соединение пула; возвращает длительность."""
+    started = time.perf_counter()
     await safe_create_tables()
     repo = RatingRepository()
     await repo.initialize_default_models()
+    # Рейтинги читаются из колоночного кэша в памяти, БД нужна только для записи
+    await repo.load_cache()
     await initialize_bot_dependencies(repo)
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    return time.perf_counter() - started
+
+async def main():
+    logger.info("Импорт модулей: %.3f с", IMPORT_SECONDS)
+    # Прогрев (метрики, эталон ColorChecker, шрифты matplotlib) идёт в потоке,
+    # параллельно с подготовкой БД, чтобы первое фото не платило за холодный старт
+    started = time.perf_counter()
+    _, db_seconds = await asyncio.gather(asyncio.to_thread(warm_up), prepare_database())
+    logger.info("Прогрев БД: %.3f с", db_seconds)
+    logger.info(
+        "Готов к работе: импорт %.3f с + прогрев %.3f с",
+        IMPORT_SECONDS, time.perf_counter() - started,
+    )
+
+    # Эндпоинт /metrics для Prometheus (только если задан METRICS_PORT)
+    metrics_runner = None
+    if os.getenv("METRICS_PORT"):
+        metrics_runner = await start_metrics_server(int(os.getenv("METRICS_PORT")))
 
     dp = Dispatcher()
     dp.include_router(router)
@@ -27,10 +64,18 @@ async def main():
     except Exception as e:
         print(f"Ошибка: {e}")
     finally:
+        # Даём досохранить результаты и отправить диаграммы, уже запущенные в фоне
+        await wait_background_tasks()
+        if metrics_runner:
+            await metrics_runner.cleanup()
         await bot.session.close()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,214 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Простейший реестр метрик в текстовом формате Prometheus (без внешних зависимостей).
+# Метрики можно обновлять из любых потоков; отдаются через /metrics (см. monitoring.server).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def register_collector(self, collector):
+        """
+        collector() -> [(имя, тип, описание, [(метки, значение), ...]), ...]
+        Вызывается при каждом запросе /metrics; нужен для значений, которые
+        удобнее прочитать в момент запроса (например, статистика кэшей).
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+
+        for collector in collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}_total{_format_labels(self._labels(key))} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values = {(): 0}
+        return [
+            f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with и записывает её в гистограмму."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in values.items():
+            labels = self._labels(key)
+            for bound, count in zip(self.buckets, counts):
+                bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+# Метрики конвейера обработки фото
+STAGE_SECONDS = Histogram(
+    "camera_bot_stage_seconds",
+    "Длительность этапов обработки фото (download, decode, analyze, chart, db_write, reply)",
+    ["stage"],
+)
+METRIC_SECONDS = Histogram(
+    "camera_bot_metric_seconds",
+    "Длительность расчёта отдельной метрики изображения",
+    ["metric"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "camera_bot_db_query_seconds",
+    "Длительность запросов RatingRepository",
+    ["query"],
+)
+QUEUE_DEPTH = Gauge(
+    "camera_bot_queue_depth",
+    "Фото, принятые в обработку, но ещё не начавшие анализ",
+)
+INFLIGHT_JOBS = Gauge(
+    "camera_bot_inflight_jobs",
+    "Фото, которые сейчас обрабатываются",
+)
+OUTBOUND_QUEUE = Gauge(
+    "camera_bot_outbound_queue",
+    "Исходящие запросы к Telegram, ожидающие своей очереди по лимитам",
+)
+OUTBOUND_RETRY_AFTER = Counter(
+    "camera_bot_outbound_retry_after",
+    "Ответы Telegram RetryAfter (flood control) на исходящие запросы",
+    ["method"],
+)
@@ -0,0 +1,161 @@
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Профилирование по запросу: следующие N анализов профилируются cProfile и
+# сэмплирующим профайлером стеков. Включается командой администратора /profile N
+# или переменной окружения PROFILE_NEXT=N (при старте бота).
+# Для каждого запроса в PROFILE_DIR пишутся:
+# - <время>_<фото>.prof   - дамп cProfile (snakeviz, pstats)
+# - <время>_<фото>.folded - свёрнутые стеки для flamegraph.pl / speedscope
+#
+# В Python 3.12 cProfile подключается ко всему процессу через sys.monitoring: включённым
+# может быть только один профилировщик, а второй enable() падает с ValueError. Поэтому
+# профилируемые участки разных запросов выполняются по очереди (_section_lock), а ошибка
+# профилировщика никогда не ломает сам анализ - участок просто не профилируется.
+# cProfile при этом видит вызовы всех потоков, и в .prof попадают анализы других
+# пользователей, идущие одновременно; .folded содержит только стеки потока самого запроса.
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+SAMPLE_INTERVAL = 0.005  # Период сэмплирования стеков, сек
+TOP_FUNCTIONS = 15  # Сколько функций показывать в сводке
+SECTION_WAIT = 30  # Сколько ждать участка другого запроса, сек; дольше - участок не профилируется
+
+_lock = threading.Lock()
+_section_lock = threading.Lock()  # Включённым может быть только один cProfile на процесс
+_remaining = int(os.getenv("PROFILE_NEXT", "0") or 0)
+_requested_by = None  # Чат, куда отправлять сводки
+
+
+def request_profiling(count: int, chat_id=None):
+    """Профилировать следующие count анализов; сводки отправлять в chat_id."""
+    global _remaining, _requested_by
+    with _lock:
+        _remaining = max(0, count)
+        _requested_by = chat_id
+
+
+def pending():
+    """Сколько анализов ещё будет профилировано."""
+    with _lock:
+        return _remaining
+
+
+def start_request(name):
+    """RequestProfile, если текущий запрос нужно профилировать, иначе None."""
+    global _remaining
+    with _lock:
+        if _remaining <= 0:
+            return None
+        _remaining -= 1
+        chat_id = _requested_by
+    return RequestProfile(name, chat_id)
+
+
+class _StackSampler(threading.Thread):
+    """Периодически снимает стек заданного потока и копит свёрнутые стеки."""
+
+    def __init__(self, thread_id, stacks):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = stacks
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+
+class RequestProfile:
+    """Профиль одного запроса; может собираться из нескольких синхронных участков."""
+
+    def __init__(self, name, chat_id=None):
+        self.name = name
+        self.chat_id = chat_id
+        self.started = time.time()
+        self.profile = cProfile.Profile()
+        self.stacks = Counter()
+
+    @contextmanager
+    def section(self):
+        """
+        Профилирует синхронный участок кода (анализ, отрисовка диаграмм).
+        Участки разных запросов выполняются по очереди; если профилировщик занят
+        дольше SECTION_WAIT или не включился, участок выполняется без профилирования.
+        """
+        profiling = _section_lock.acquire(timeout=SECTION_WAIT)
+        if not profiling:
+            logger.warning("Профилировщик занят другим запросом, участок %s не профилируется", self.name)
+        else:
+            try:
+                self.profile.enable()
+            except ValueError as e:  # Включён другой профилировщик (например, внешний)
+                _section_lock.release()
+                profiling = False
+                logger.warning("Не удалось включить профилировщик для %s: %s", self.name, e)
+        if not profiling:
+            yield
+            return
+
+        sampler = _StackSampler(threading.get_ident(), self.stacks)
+        sampler.start()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            sampler.stop_event.set()
+            sampler.join()
+            _section_lock.release()
+
+    def finish(self):
+        """Сохраняет дампы и возвращает текстовую сводку по самым дорогим функциям."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        safe_name = re.sub(r"[^\w.-]", "_", self.name or "photo")
+        base = os.path.join(
+            PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}_{safe_name}"
+        )
+        self.profile.dump_stats(base + ".prof")
+        with open(base + ".folded", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        stats = pstats.Stats(self.profile).stats
+        if not stats:
+            return f"Профиль {self.name}: нет данных"
+        # (файл, строка, функция) -> (примитивные вызовы, вызовы, собственное время, суммарное время, ...)
+        top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:TOP_FUNCTIONS]
+        total = sum(own for _, _, own, _, _ in stats.values())
+        lines = [f"Профиль {self.name} ({total:.2f} с):", f"Файлы: {base}.prof, {base}.folded", ""]
+        for (filename, lineno, function), (_, calls, own, cumulative, _) in top:
+            lines.append(
+                f"{own:.3f} с / {cumulative:.3f} с  {calls}×  {function} ({os.path.basename(filename)}:{lineno})"
+            )
+        summary = "\n".join(lines)
+        logger.info(summary)
+        return summary
+
+
+@contextmanager
+def section(request_profile):
+    """Участок профилирования или пустой блок, если запрос не профилируется."""
+    if request_profile is None:
+        yield
+    else:
+        with request_profile.section():
+            yield
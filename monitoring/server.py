@@ -0,0 +1,47 @@
+import logging
+
+from aiohttp import web
+
+from image_analyz.image_cache import cache_stats
+from monitoring.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+def _collect_cache_stats():
+    stats = cache_stats()
+    requests = []
+    hit_ratio = []
+    for name, info in stats.items():
+        requests.append(({"cache": name, "result": "hit"}, info.hits))
+        requests.append(({"cache": name, "result": "miss"}, info.misses))
+        total = info.hits + info.misses
+        hit_ratio.append(({"cache": name}, info.hits / total if total else 0.0))
+    return [
+        ("camera_bot_cache_requests_total", "counter", "Обращения к кэшам анализа", requests),
+        ("camera_bot_cache_hit_ratio", "gauge", "Доля попаданий в кэши анализа", hit_ratio),
+    ]
+
+
+REGISTRY.register_collector(_collect_cache_stats)
+
+
+async def _handle_metrics(request):
+    return web.Response(
+        text=REGISTRY.render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    """
+    Поднимает локальный HTTP-сервер с эндпоинтом /metrics в формате Prometheus.
+    Возвращает runner; для остановки: await runner.cleanup().
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%d/metrics", host, port)
+    return runner
@@ -9,13 +9,15 @@ import cv2
 import numpy as np
 from data.db import engine
 from data.models import Base
+from data.schema import upgrade_schema
 from bot.telegram_bot import (
     router,
     initialize_bot_dependencies,
     ANALYSIS_METHODS,
     user_methods,
     user_phone_models,
-    bot
+    bot,
+    wait_background_tasks,
 )
 from data.repository import RatingRepository
 
@@ -45,7 +47,8 @@ class MockMessage:
         self.text = text
         self.document = document
         self.message_id = random.randint(1000, 9999)
-        self.reply = self.answer = self.answer_photo = AsyncMock()
+        self.media_group_id = None
+        self.reply = self.answer = self.answer_photo = self.answer_media_group = AsyncMock()
         self.caption = None
 
 class MockCallbackQuery:
@@ -65,6 +68,7 @@ async def safe_create_tables():
     print("Создание таблиц в БД...")
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await upgrade_schema()
     print("Таблицы созданы")
 
 class BotTester:
@@ -78,6 +82,7 @@ class BotTester:
         await safe_create_tables()
         await initialize_bot_dependencies(self.repo)
         await self.repo.initialize_default_models()
+        await self.repo.load_cache()
         print("Зависимости инициализированы, дефолтные модели добавлены")
 
     async def simulate_photo_upload(self, user, method_id):
@@ -102,6 +107,29 @@ class BotTester:
         os.remove(temp_path)
         print(f"Временный файл удалён: {temp_path}")
 
+    async def simulate_album_upload(self, user, method_id, num_photos=5):
+        print(f"Симуляция отправки альбома из {num_photos} фото для user_{user.id}, метод: {method_id}")
+        chat = MockChat(user.id)
+        temp_path = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg").name
+        cv2.imwrite(temp_path, create_test_image())
+
+        class FakeFile:
+            file_path = temp_path
+
+        # Альбом обрабатывается в фоне после паузы, поэтому ждём фоновые задачи внутри patch
+        with patch("cv2.imread", return_value=cv2.imread(temp_path)), \
+             patch("bot.telegram_bot.bot.get_file", AsyncMock(return_value=FakeFile())), \
+             patch("bot.telegram_bot.bot.download_file", AsyncMock()):
+            for i in range(num_photos):
+                mock_document = MockDocument(f"fake_id_{i}", f"album_{user.id}_{method_id}_{i}.jpg")
+                msg = MockMessage(user, chat, document=mock_document)
+                msg.media_group_id = f"album_{user.id}"
+                await self.find_and_call_handler(router.message.handlers, "handle_photo", msg)
+            await wait_background_tasks()
+            print(f"Альбом обработан для user_{user.id}")
+
+        os.remove(temp_path)
+
     async def simulate_method_selection(self, user, method_id):
         print(f"Симуляция выбора метода {method_id} для user_{user.id}")
         chat = MockChat(user.id)
@@ -148,6 +176,9 @@ class BotTester:
         try:
             tasks = [self.run_user(user) for user in self.users]
             await asyncio.gather(*tasks)
+            await self.simulate_album_upload(self.users[0], user_methods[self.users[0].id])
+            # Диаграммы и запись в БД отправляются в фоне после ответа с оценками
+            await wait_background_tasks()
         finally:
             await bot.session.close()
             print("Сессия бота закрыта")